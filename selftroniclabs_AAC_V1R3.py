@@ -1,168 +1,2539 @@
+import time
+_PROCESS_START = time.perf_counter()
+
 import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
-import pyttsx3
+from tkinter import ttk, messagebox
 import threading
-import time
+import asyncio
+import concurrent.futures
+import queue
+import itertools
+import argparse
 import random
+import tempfile
+import types
+import heapq
+import math
+import os
+import sys
+import json
+import re
+import hashlib
+import base64
+import urllib.parse
+import shutil
+import subprocess
+import wave
+import gzip
+import io
+import array
+from collections import OrderedDict, deque
 
-class AACApp(tk.Tk):
+try:
+    import winsound
+except ImportError:
+    winsound = None
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 本地缓存目录（语音缓存等）
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".selftronic_aac")
+
+# --- 语音发现 ---
+VOICE_CACHE_FILE = os.path.join(APP_DATA_DIR, "voices.json")
+
+# 按语言自动挑选语音时匹配的语言代码和名称关键字；其他语言只按语言代码匹配
+VOICE_HINTS = {
+    'zh': ('zh', ('chinese', 'sinji', 'ting-ting')),
+    'en': ('en', ('english', 'alex', 'david')),
+}
+
+
+def create_tts_engine():
+    # pyttsx3 在语音线程里第一次需要时才导入并初始化，不拖慢窗口启动
+    import pyttsx3
+    return pyttsx3.init()
+
+
+def default_tts_driver():
+    # 与 pyttsx3.init() 默认选择的驱动一致
+    if sys.platform == 'win32':
+        return 'sapi5'
+    if sys.platform == 'darwin':
+        return 'nsss'
+    return 'espeak'
+
+
+def describe_voices(voices):
+    # 把 pyttsx3 的 Voice 对象转成可缓存的字典
+    result = []
+    for voice in voices:
+        langs = [l.decode('utf-8', 'ignore') if isinstance(l, bytes) else str(l) for l in (voice.languages or [])]
+        result.append({'id': voice.id, 'name': voice.name or voice.id, 'languages': langs})
+    return result
+
+
+def voice_inventory_key(driver, voices):
+    ids = "\n".join(sorted(v['id'] for v in voices))
+    return driver + ":" + hashlib.sha1(ids.encode('utf-8')).hexdigest()
+
+
+def pick_language_voices(voices, languages=None):
+    # 每种语言取第一个匹配的语音
+    hints = {lang: VOICE_HINTS.get(lang, (lang, ())) for lang in (languages or VOICE_HINTS)}
+    mapping = {}
+    for voice in voices:
+        v_name = voice['name'].lower()
+        for lang, (code, names) in hints.items():
+            if lang not in mapping and (code in voice['languages'] or any(n in v_name for n in names)):
+                mapping[lang] = voice['id']
+    return mapping
+
+
+def load_voice_cache(driver, path=VOICE_CACHE_FILE):
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('driver') != driver:
+        return None
+    return data
+
+
+def save_voice_cache(driver, voices, mapping, path=VOICE_CACHE_FILE):
+    data = {'driver': driver, 'key': voice_inventory_key(driver, voices), 'voices': voices, 'mapping': mapping}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Voice cache error: {e}")
+
+
+# --- 性能指标 ---
+# 一次点击经过的阶段：点击 -> 入队 -> 语音线程取出 -> 引擎就绪 -> 开始发声
+LATENCY_STAGES = ('tap', 'enqueued', 'dequeued', 'engine_ready', 'audio_start')
+
+
+class LatencyTracker:
+    # 每次点击带一条 trace（阶段 -> 单调时钟时间戳），相邻阶段的耗时和点击到发声的总耗时
+    # 记入滚动窗口，随时可以算 p50/p95/p99；另有计数器和仪表值（当前值与最大值）。
+    # 给了 log（UsageLog）时点击到发声的总耗时也写进使用记录
+    def __init__(self, window=1000, log=None):
+        self.window = window
+        self.log = log
+        self.samples = {}   # 名称 -> deque（毫秒）
+        self.counters = {}
+        self.gauges = {}    # 名称 -> [当前值, 最大值]
+        self._lock = threading.Lock()
+
+    def begin(self):
+        return {'tap': time.perf_counter(), 'last': 'tap'}
+
+    def mark(self, trace, stage):
+        # 同一阶段只记第一次（例如被打断后重新发声不算）
+        if trace is None or stage in trace:
+            return
+        now = time.perf_counter()
+        last = trace['last']
+        trace[stage] = now
+        trace['last'] = stage
+        self.observe(f"{last}->{stage}", (now - trace[last]) * 1000)
+        if stage == LATENCY_STAGES[-1]:
+            total = (now - trace['tap']) * 1000
+            self.observe("tap->audio_start", total)
+            if self.log is not None:
+                self.log.record('latency', round(total, 1))
+
+    def observe(self, name, ms):
+        with self._lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(ms)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self._lock:
+            current = self.gauges.get(name)
+            if current is None:
+                self.gauges[name] = [value, value]
+            else:
+                current[0] = value
+                if value > current[1]:
+                    current[1] = value
+
+    def percentiles(self, name):
+        with self._lock:
+            ordered = sorted(self.samples.get(name, ()))
+        if not ordered:
+            return None
+        pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+        return {'count': len(ordered), 'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 3)}
+
+    def snapshot(self):
+        with self._lock:
+            names = sorted(self.samples)
+            counters = dict(self.counters)
+            gauges = {name: {'current': v[0], 'max': v[1]} for name, v in self.gauges.items()}
+        return {
+            'histograms_ms': {name: self.percentiles(name) for name in names},
+            'counters': counters,
+            'gauges': gauges,
+        }
+
+    def export(self, path):
+        data = self.snapshot()
+        data['exported_at'] = time.time()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, path)
+        return path
+
+
+# --- 使用记录 ---
+# 点了哪些词卡、说了哪些句子、用了哪些扩展、紧急呼叫和发声延迟，追加写入 usage.jsonl，用来调整面板。
+# record() 只往内存队列里放一个元组（约 1 微秒），编码和写盘都在后台线程里按批进行。
+# 每批一次 write 加 fsync；崩溃时最多留下半行，读取时跳过，重新打开时先补上换行。文件超过大小上限就轮转
+USAGE_LOG_FILE = "usage.jsonl"
+USAGE_LOG_MAX_BYTES = 4 * 1024 * 1024
+USAGE_LOG_BACKUPS = 5          # 保留 usage.jsonl.1 ... usage.jsonl.5
+USAGE_FLUSH_INTERVAL = 2.0     # 后台写盘间隔（秒）
+USAGE_BUFFER_MAX = 50000       # 写盘跟不上时内存里最多留这么多条，更早的丢弃
+USAGE_TOP = 20
+
+
+class UsageLog:
+    # 每条记录一行 JSON 数组：[时间戳, 类型, 字段...]
+    def __init__(self, path, max_bytes=USAGE_LOG_MAX_BYTES, backups=USAGE_LOG_BACKUPS, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._buffer = deque(maxlen=USAGE_BUFFER_MAX)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def record(self, kind, *fields):
+        # 点击路径上调用：deque.append 本身是线程安全的，不加锁
+        self._buffer.append((time.time(), kind, fields))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="usage-log", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def flush(self):
+        with self._lock:
+            buffer = self._buffer
+            lines = []
+            while buffer:
+                ts, kind, fields = buffer.popleft()
+                lines.append(json.dumps([round(ts, 3), kind, *fields], ensure_ascii=False, separators=(',', ':')))
+            if not lines:
+                return 0
+            data = ("\n".join(lines) + "\n").encode('utf-8')
+            try:
+                f = self._open()
+                if f.tell() and f.tell() + len(data) > self.max_bytes:
+                    f = self._rotate()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError as e:
+                print(f"Usage log write error: {e}")
+            return len(lines)
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            f = open(self.path, 'ab+')
+            # 上次没写完的半行和新记录分开
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            self._file = f
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        return self._open()
+
+
+def read_usage_log(path, backups=USAGE_LOG_BACKUPS):
+    # 从最旧的轮转文件读到当前文件，逐条返回 (时间戳, 类型, [字段])；写了一半或损坏的行跳过
+    for name in [f"{path}.{n}" for n in range(backups, 0, -1)] + [path]:
+        try:
+            f = open(name, encoding='utf-8', errors='replace')
+        except OSError:
+            continue
+        with f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(event, list) and len(event) >= 2:
+                    yield event[0], event[1], event[2:]
+
+
+def usage_stats(events, vocab=None, top=USAGE_TOP):
+    # 把使用记录汇总成统计：各类事件数、最常用的词卡/分类/句子/扩展/常用句、紧急呼叫次数和发声延迟分位数。
+    # 给了 vocab 时词卡 ID 换成文字
+    counts, cards, categories = {}, {}, {}
+    played, expanded, recalled = {}, {}, {}
+    latencies, emergencies, sessions = [], [], 0
+    first = last = None
+    for ts, kind, fields in events:
+        first = ts if first is None else first
+        last = ts
+        counts[kind] = counts.get(kind, 0) + 1
+        if kind == 'tap' and len(fields) >= 2:
+            item_id, category = fields[0], fields[1]
+            key = item_id if item_id is not None else f"manual:{fields[2] if len(fields) > 2 else ''}"
+            cards[key] = cards.get(key, 0) + 1
+            categories[category] = categories.get(category, 0) + 1
+        elif kind in ('play', 'expand', 'phrase') and fields:
+            target = played if kind == 'play' else expanded if kind == 'expand' else recalled
+            target[fields[-1]] = target.get(fields[-1], 0) + 1
+        elif kind == 'latency' and fields:
+            latencies.append(fields[0])
+        elif kind == 'emergency':
+            emergencies.append(ts)
+        elif kind == 'start':
+            sessions += 1
+
+    def card_label(key):
+        entry = vocab.by_id(key) if vocab is not None and isinstance(key, int) else None
+        return f"{entry.emoji} {entry[DEFAULT_LANGUAGE]}" if entry is not None else str(key)
+
+    def ranked(table, label=str):
+        return [[label(key), n] for key, n in heapq.nlargest(top, table.items(), key=lambda kv: kv[1])]
+    return {
+        'events': sum(counts.values()),
+        'first': first,
+        'last': last,
+        'sessions': sessions,
+        'counts': counts,
+        'top_cards': ranked(cards, card_label),
+        'top_categories': ranked(categories),
+        'top_played': ranked(played),
+        'top_expansions': ranked(expanded),
+        'top_phrases': ranked(recalled),
+        'emergencies': len(emergencies),
+        'last_emergency': emergencies[-1] if emergencies else None,
+        'tap_to_audio_ms': _percentiles(latencies) if latencies else None,
+    }
+
+
+def run_usage_stats(data_dir=APP_DATA_DIR, vocab_path=None, out=sys.stdout):
+    vocab = VocabularyStore(vocab_path or VOCABULARY_FILE)
+    stats = usage_stats(read_usage_log(os.path.join(data_dir, USAGE_LOG_FILE)), vocab)
+    out.write(json.dumps(stats, indent=2, ensure_ascii=False) + "\n")
+    return 0 if stats['events'] else 1
+
+
+# --- 语音服务 ---
+# 优先级数值越小越先朗读：紧急 > 扩展句/整句 > 单词点击 > 预测扩展句的预合成 > 后台批量预合成
+# PRIORITY_SPECULATIVE 及以上都是只写缓存、不发声的合成任务
+PRIORITY_EMERGENCY = 0
+PRIORITY_EXPANSION = 1
+PRIORITY_WORD = 2
+PRIORITY_SPECULATIVE = 3
+PRIORITY_PREFETCH = 4
+AUDIO_INDEX_SAVE_S = 5.0  # 缓存索引改动后隔多久写盘
+
+
+class AudioCache:
+    # 预合成语音缓存：按 (文本, 语音ID, 语速, 音量) 存 wav 文件，按总大小做 LRU 淘汰。
+    # prerendered 是 --prerender 批量生成的目录（压缩音频 + 清单），未命中时从那里解压取用
+    def __init__(self, directory=None, max_bytes=64 * 1024 * 1024, prerendered=None):
+        self.directory = directory or os.path.join(APP_DATA_DIR, "audio_cache")
+        self.max_bytes = max_bytes
+        self.prerendered_dir = prerendered
+        self._prerendered = None  # 清单在第一次查询时才读
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> meta，最久未用的在前
+        self._total = 0
+        self._dirty = False
+        self._save_timer = None
+        self._save_lock = threading.Lock()  # 保证索引按快照的先后顺序写盘
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(text, voice_id, rate, volume):
+        raw = json.dumps([text, voice_id, rate, volume], ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + ".wav")
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries or key in self._prerendered_locked()
+
+    def get(self, text, voice_id, rate, volume):
+        key = self.make_key(text, voice_id, rate, volume)
+        with self._lock:
+            if key not in self._entries:
+                return self._unpack_locked(key) if key in self._prerendered_locked() else None
+            self._entries.move_to_end(key)
+        path = self.path_for(key)
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            meta = self._entries.pop(key, None)
+            if meta: self._total -= meta['size']
+        return None
+
+    def _prerendered_locked(self):
+        if self._prerendered is None:
+            self._prerendered = load_prerender_manifest(self.prerendered_dir) if self.prerendered_dir else {}
+        return self._prerendered
+
+    def _unpack_locked(self, key):
+        # 把批量预合成的压缩音频解压进缓存目录（单个词约 1 毫秒）
+        meta = self._prerendered[key]
+        path = self.path_for(key)
+        try:
+            with gzip.open(os.path.join(self.prerendered_dir, key + ".wav.gz"), 'rb') as src, open(path + ".tmp", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(path + ".tmp", path)
+        except (OSError, EOFError) as e:
+            print(f"Prerendered clip error: {e}")
+            del self._prerendered[key]
+            return None
+        size = os.path.getsize(path)
+        self._entries[key] = {'text': meta['text'], 'voice_id': meta['voice_id'], 'rate': meta['rate'], 'volume': meta['volume'], 'size': size}
+        self._total += size
+        self._evict_locked()
+        self._changed_locked()
+        return path if key in self._entries else None
+
+    def add(self, key, text, voice_id, rate, volume):
+        size = os.path.getsize(self.path_for(key))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old: self._total -= old['size']
+            self._entries[key] = {'text': text, 'voice_id': voice_id, 'rate': rate, 'volume': volume, 'size': size}
+            self._total += size
+            self._evict_locked()
+            self._changed_locked()
+
+    def invalidate(self, voice_id=None, rate=None):
+        # 删除与给定语音/语速匹配的全部缓存（两者都为 None 时清空）
+        with self._lock:
+            for key, meta in list(self._entries.items()):
+                if voice_id is not None and meta['voice_id'] != voice_id: continue
+                if rate is not None and meta['rate'] != rate: continue
+                self._remove_locked(key)
+            self._changed_locked()
+
+    def _remove_locked(self, key):
+        meta = self._entries.pop(key)
+        self._total -= meta['size']
+        try: os.remove(self.path_for(key))
+        except OSError: pass
+
+    def _evict_locked(self):
+        while self._total > self.max_bytes and self._entries:
+            self._remove_locked(next(iter(self._entries)))
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, "index.json"), encoding='utf-8') as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, meta in records:
+            if os.path.exists(self.path_for(key)):
+                self._entries[key] = meta
+                self._total += meta['size']
+
+    def _changed_locked(self):
+        # 几千条时重写一次索引要上百毫秒，不能在每次插入时（还拿着锁）做：
+        # 改动后由计时器线程在 AUDIO_INDEX_SAVE_S 秒后合并写一次，写盘时不持有 _lock
+        self._dirty = True
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(AUDIO_INDEX_SAVE_S, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                records = list(self._entries.items())
+            path = os.path.join(self.directory, "index.json")
+            try:
+                with open(path + ".tmp", 'w', encoding='utf-8') as f:
+                    json.dump(records, f, ensure_ascii=False)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"Audio cache error: {e}")
+
+    def close(self):
+        self.save()
+
+
+def wav_duration(path):
+    try:
+        with wave.open(path, 'rb') as w:
+            return w.getnframes() / float(w.getframerate())
+    except Exception:
+        return 2.0
+
+
+class AudioPlayer:
+    # 直接播放缓存的音频文件，不经过 TTS 引擎；stop_event 被置位时立即停止。
+    # 语音线程和紧急通道共用一个播放器：winsound 一个进程同时只能放一个声音，
+    # 所以记下当前在放的是哪一次 start()，停止时只停自己的，不会把后来开始的警报音停掉
     def __init__(self):
-        super().__init__()
+        self.command = None
+        self._lock = threading.Lock()
+        self._sounding = None
+        if sys.platform.startswith('win'):
+            self.available = winsound is not None
+        else:
+            for cmd in (['afplay'], ['aplay', '-q'], ['paplay']):
+                if shutil.which(cmd[0]):
+                    self.command = cmd
+                    break
+            self.available = self.command is not None
 
-        self.title("Selftronic AAC V1R3 (Python Desktop)")
-        self.geometry("1100x750")
-        self.configure(bg="#f0f2f5")
+    def play(self, path, stop_event):
+        self.wait(self.start(path), stop_event)
+
+    def start(self, path):
+        # 开始播放后立即返回，之后用 wait() 等它播完；这段时间里调用方可以准备下一段
+        if self.command is None:
+            handle = types.SimpleNamespace(deadline=time.monotonic() + wav_duration(path))
+            with self._lock:
+                winsound.PlaySound(path, winsound.SND_FILENAME | winsound.SND_ASYNC | winsound.SND_NODEFAULT)
+                self._sounding = handle
+            return handle
+        return subprocess.Popen(self.command + [path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _stop_sound(self, handle):
+        with self._lock:
+            if self._sounding is handle:
+                winsound.PlaySound(None, 0)
+                self._sounding = None
+
+    def wait(self, handle, stop_event):
+        if self.command is None:
+            if stop_event.wait(max(0.0, handle.deadline - time.monotonic())):
+                self._stop_sound(handle)
+            return
+        while handle.poll() is None:
+            if stop_event.wait(0.02):
+                handle.terminate()
+                break
+
+    def stop(self, handle):
+        # 从其他线程停掉 start() 开始的播放
+        if self.command is None:
+            self._stop_sound(handle)
+        elif handle.poll() is None:
+            handle.terminate()
+
+
+# 长句分段朗读：先按标点分成短语，太长的短语再按词（中文按字）切开。
+# 第一段尽量短，让声音和单个词一样快地出来
+PHRASE_BREAK = re.compile(r'(?<=[.,!?;:，。！？；：、])\s*')
+STREAM_FIRST_WORDS = 3
+STREAM_CHUNK_WORDS = 8
+STREAM_CHARS_PER_WORD = 2  # 没有空格的文字按几个字算一个词
+
+
+def split_phrases(text):
+    chunks = []
+    for phrase in PHRASE_BREAK.split(text.strip()):
+        phrase = phrase.strip()
+        if not phrase:
+            continue
+        spaced = ' ' in phrase
+        units = phrase.split() if spaced else list(phrase)
+        while units:
+            limit = STREAM_FIRST_WORDS if not chunks else STREAM_CHUNK_WORDS
+            if not spaced:
+                limit *= STREAM_CHARS_PER_WORD
+            # 剩下的不多时并进当前段，避免最后只剩一两个词单独成段
+            if len(units) <= limit + limit // 2:
+                limit = len(units)
+            chunks.append((' ' if spaced else '').join(units[:limit]))
+            units = units[limit:]
+    return chunks
+
+
+class SpeechService:
+    # 一个常驻线程持有唯一的 pyttsx3 引擎，从优先级队列中取任务朗读，
+    # 避免每次点击都新建线程并重新 pyttsx3.init()
+    def __init__(self, engine_factory=None, cache=None, player=None, metrics=None):
+        self.engine_factory = engine_factory or create_tts_engine
+        self.engine = None
+        self.cache = cache
+        self.player = player
+        self.metrics = metrics or LatencyTracker()
+        self.on_start = None  # 开始发声时在语音线程里回调（用于测量延迟）
+        self._props = {}
+        self._rendering = False
+        self._pending_renders = {}  # key -> is_current 判断函数（None 表示一直有效）
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._interrupt = threading.Event()
+        self._latest_word_seq = -1
+        self._flush_seq = -1
+        self._suspended = False  # 紧急警报响着的时候只让紧急朗读出声
+        self._current_priority = None
+        self._current_trace = None
+        self._playing = None         # 分段朗读时正在后台播放的片段，打断时直接停掉
+        self._current_render = None  # 正在合成到缓存的键，新的朗读或结果过时时打断它
+        self._render_interruptible = False
+        self._thread = threading.Thread(target=self._run, name="SpeechService", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        self.interrupt()
+        self._queue.put((-1, next(self._seq), None))
+
+    def speak(self, text, priority=PRIORITY_WORD, voice_id=None, rate=150, volume=1.0, trace=None, done=None):
+        # trace 是 LatencyTracker.begin() 返回的记录，各阶段的时间戳会记到里面；
+        # done 是 threading.Event，说完、被打断或被丢弃时置位
+        if not text:
+            return
+        waited = time.perf_counter()
+        with self._lock:
+            self.metrics.observe('speak_lock_wait', (time.perf_counter() - waited) * 1000)
+            seq = next(self._seq)
+            if priority == PRIORITY_WORD:
+                # 只保留最新的单词点击，之前排队的单词会被丢弃
+                self._latest_word_seq = seq
+            current = self._current_priority
+            # 新的朗读打断当前朗读（紧急呼叫只能被紧急呼叫打断）；
+            # 正在合成到缓存的也要让路，还有用的话说完后重新合成
+            if current is not None and current < PRIORITY_SPECULATIVE and (current != PRIORITY_EMERGENCY or priority == PRIORITY_EMERGENCY):
+                self._interrupt_locked()
+            elif self._current_render is not None:
+                self._interrupt_locked()
+        job = {'text': text, 'voice_id': voice_id, 'rate': rate, 'volume': volume, 'trace': trace, 'done': done}
+        # 放进队列之前记时间：放进去之后语音线程马上就可能取走它并记 dequeued
+        self.metrics.mark(trace, 'enqueued')
+        self._queue.put((priority, seq, job))
+        self.metrics.gauge('queue_depth', self._queue.qsize())
+
+    def prefetch(self, text, voice_id=None, rate=150, volume=1.0, priority=PRIORITY_PREFETCH, is_current=None):
+        # 空闲时把文本合成到缓存文件，之后点击可直接播放；
+        # is_current() 返回 False 时说明结果已经过时，轮到它时直接跳过
+        if not text or self.cache is None:
+            return
+        key = self.cache.make_key(text, voice_id, rate, volume)
+        with self._lock:
+            if self.cache.contains(key):
+                return
+            pending = key in self._pending_renders
+            self._pending_renders[key] = is_current
+            if pending and priority == PRIORITY_PREFETCH:
+                return
+        job = {'text': text, 'voice_id': voice_id, 'rate': rate, 'volume': volume, 'render': key}
+        self._queue.put((priority, next(self._seq), job))
+
+    def backlog(self):
+        # 排队还没说的朗读数（不含预合成和推测合成）
+        with self._queue.mutex:
+            return sum(1 for priority, _, job in self._queue.queue if 0 <= priority < PRIORITY_SPECULATIVE)
+
+    def discover_voices(self, callback):
+        # 在语音线程里初始化引擎并枚举语音，完成后 callback(voices)（在语音线程中调用）
+        self._queue.put((PRIORITY_EXPANSION, next(self._seq), {'voices': callback}))
+
+    def interrupt(self, flush=False):
+        # 停止正在说的话；flush 时连同已排队还没开始的朗读一起丢掉（预合成不受影响）
+        with self._lock:
+            if flush:
+                self._flush_seq = next(self._seq)
+            if self._current_priority is not None and self._current_priority < PRIORITY_SPECULATIVE:
+                self._interrupt_locked()
+
+    def _interrupt_locked(self):
+        self._interrupt.set()
+        # 语音线程可能正在合成下一段，不能等它回来检查，正在播放的片段在这里就停
+        if self._playing is not None:
+            self.player.stop(self._playing)
+
+    def cancel_stale(self):
+        # 句子变了：正在合成的推测结果已经过时就停下，不再等它合成完
+        with self._lock:
+            is_current = self._pending_renders.get(self._current_render)
+            if is_current is not None and not is_current():
+                self._interrupt_locked()
+
+    def suspend(self):
+        # 停掉正在说的和排队的朗读，之后到 resume() 之前除紧急朗读外的朗读一律丢弃（预合成照常）
+        with self._lock:
+            self._suspended = True
+        self.interrupt(flush=True)
+
+    def resume(self):
+        with self._lock:
+            self._suspended = False
+
+    def _run(self):
+        while True:
+            priority, seq, job = self._queue.get()
+            if job is None:
+                break
+            self.metrics.gauge('queue_depth', self._queue.qsize())
+            # 枚举语音这样的控制任务不出声，不受清空和暂停影响
+            spoken = 'text' in job and 'render' not in job
+            with self._lock:
+                if priority == PRIORITY_WORD and seq < self._latest_word_seq:
+                    self._drop(job, 'stale_words_dropped')
+                    continue
+                if spoken and priority < PRIORITY_SPECULATIVE and seq < self._flush_seq:
+                    self._drop(job, 'flushed')
+                    continue
+                if spoken and self._suspended and PRIORITY_EMERGENCY < priority < PRIORITY_SPECULATIVE:
+                    self._drop(job, 'suspended_dropped')
+                    continue
+                self._current_priority = priority
+                self._current_trace = job.get('trace')
+                self._current_render = job.get('render')
+                self._interrupt.clear()
+            self.metrics.mark(self._current_trace, 'dequeued')
+            try:
+                if 'render' in job:
+                    self._render(job, priority)
+                elif 'voices' in job:
+                    job['voices'](self._ensure_engine().getProperty('voices'))
+                else:
+                    self._say(job)
+            except Exception as e:
+                print(f"Speech error: {e}")
+                self.engine = None
+                self._props = {}
+            finally:
+                with self._lock:
+                    self._current_priority = None
+                    self._current_trace = None
+                    self._current_render = None
+                if job.get('done') is not None:
+                    job['done'].set()
+        if self.engine is not None:
+            try: self.engine.stop()
+            except: pass
+
+    def _drop(self, job, counter):
+        self.metrics.count(counter)
+        if job.get('done') is not None:
+            job['done'].set()
+
+    def _ensure_engine(self):
+        if self.engine is None:
+            t0 = time.perf_counter()
+            self.engine = self.engine_factory()
+            self.metrics.observe('engine_init', (time.perf_counter() - t0) * 1000)
+            self._props = {}
+            self.engine.connect('started-word', self._on_word)
+            self.engine.connect('started-utterance', self._on_utterance)
+        return self.engine
+
+    def _on_utterance(self, name):
+        if not self._rendering:
+            self._notify_start()
+
+    def _notify_start(self):
+        self.metrics.mark(self._current_trace, 'audio_start')
+        if self.on_start is not None:
+            try: self.on_start()
+            except Exception: pass
+
+    def _on_word(self, name, location, length):
+        # 在引擎回调里检查打断请求，这是 pyttsx3 中途停止朗读的方式
+        if self._interrupt.is_set() and (not self._rendering or self._render_interruptible):
+            self.engine.stop()
+
+    def _set_prop(self, name, value):
+        if value is None or self._props.get(name) == value:
+            return
+        try:
+            self.engine.setProperty(name, value)
+            self._props[name] = value
+        except Exception:
+            pass
+
+    def _can_play(self):
+        return self.cache is not None and self.player is not None and self.player.available
+
+    def _say(self, job):
+        if self._can_play():
+            path = self.cache.get(job['text'], job['voice_id'], job['rate'], job['volume'])
+            if path:
+                self.metrics.count('cache_hits')
+                self._notify_start()
+                self.player.play(path, self._interrupt)
+                return
+        chunks = split_phrases(job['text'])
+        if len(chunks) > 1:
+            self._say_stream(job, chunks)
+        else:
+            self._say_engine(job)
+
+    def _say_stream(self, job, chunks):
+        # 一段一段地说，每段之间检查打断；缓存的段落在播放的同时合成下一段
+        playing = None
+        try:
+            for i, chunk in enumerate(chunks):
+                if self._interrupt.is_set():
+                    return
+                path = self.cache.get(chunk, job['voice_id'], job['rate'], job['volume']) if self._can_play() else None
+                if playing is not None:
+                    self.player.wait(playing, self._interrupt)
+                    playing = None
+                    with self._lock:
+                        self._playing = None
+                    if self._interrupt.is_set():
+                        return
+                if path is None:
+                    self._say_engine(dict(job, text=chunk))
+                    continue
+                self._notify_start()
+                playing = self.player.start(path)
+                with self._lock:
+                    self._playing = playing
+                    if self._interrupt.is_set():
+                        self.player.stop(playing)
+                if i + 1 < len(chunks):
+                    key = self.cache.make_key(chunks[i + 1], job['voice_id'], job['rate'], job['volume'])
+                    if not self.cache.contains(key):
+                        self._synthesize(key, dict(job, text=chunks[i + 1]), interruptible=True)
+        finally:
+            if playing is not None:
+                self.player.wait(playing, self._interrupt)
+            with self._lock:
+                self._playing = None
+
+    def _say_engine(self, job):
+        engine = self._ensure_engine()
+        self._set_prop('voice', job['voice_id'])
+        self._set_prop('rate', job['rate'])
+        self._set_prop('volume', job['volume'])
+        self.metrics.mark(job.get('trace'), 'engine_ready')
+        if self._interrupt.is_set():
+            return
+        engine.say(job['text'])
+        engine.runAndWait()
+
+    def _render(self, job, priority):
+        # 合成可以被打断，半截的丢掉；被新的朗读打断而结果还有用时重新排队，等空闲了再合成
+        key = job['render']
+        again = False
+        try:
+            with self._lock:
+                if key not in self._pending_renders:
+                    return
+                is_current = self._pending_renders[key]
+            if self.cache.contains(key) or (is_current is not None and not is_current()):
+                return
+            self._synthesize(key, job, interruptible=True)
+            again = self._interrupt.is_set() and not self.cache.contains(key) and (is_current is None or is_current())
+        finally:
+            with self._lock:
+                if again:
+                    self._queue.put((priority, next(self._seq), job))
+                else:
+                    self._pending_renders.pop(key, None)
+
+    def _synthesize(self, key, job, interruptible=False):
+        # 把 job 的文本合成到缓存（在语音线程里，不发声）；interruptible 时被打断就放弃，半截的不进缓存
+        engine = self._ensure_engine()
+        self._set_prop('voice', job['voice_id'])
+        self._set_prop('rate', job['rate'])
+        self._set_prop('volume', job['volume'])
+        target = self.cache.path_for(key)
+        tmp = target[:-4] + ".tmp.wav"
+        self._rendering = True
+        self._render_interruptible = interruptible
+        try:
+            engine.save_to_file(job['text'], tmp)
+            engine.runAndWait()
+        finally:
+            self._rendering = False
+            self._render_interruptible = False
+        if interruptible and self._interrupt.is_set():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        elif os.path.exists(tmp) and os.path.getsize(tmp) > 44:
+            os.replace(tmp, target)
+            self.cache.add(key, job['text'], job['voice_id'], job['rate'], job['volume'])
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+
+# --- 紧急呼叫 ---
+# 紧急呼叫不走语音队列，也不等 TTS 引擎：单独的常驻线程里放着现成的警报音（启动时在内存里生成）和
+# 每种语言的呼救语音（语音线程合成好后从缓存复制一份到频道自己的目录，不受缓存淘汰和换语音影响），
+# 触发时立即开始播放，同时停掉并清空其他朗读，警报音 + 呼救语音一直重复到有人确认。
+# 从 trigger() 到开始出声的最坏耗时不超过 EMERGENCY_MAX_START_MS，基准测试和回放压力测试都会检查。
+# 播放用文件而不是 winsound 的内存播放，因为后者不能异步、不能中途停下
+EMERGENCY_RATE = 170
+EMERGENCY_TONE_HZ = (880, 660, 880, 660)
+EMERGENCY_TONE_S = 0.8
+EMERGENCY_REPEAT_GAP_S = 1.0
+EMERGENCY_RELOAD_S = 1.0        # 空闲时每隔多久检查一次呼救语音是否已经合成好
+EMERGENCY_SPEECH_TIMEOUT_S = 10.0  # 呼救语音还没合成好、改用 TTS 说时最多等它说多久
+EMERGENCY_MAX_START_MS = 50.0   # 触发到开始出声的最坏耗时（线程唤醒加启动播放器进程）
+
+
+def alarm_tone(frequencies=EMERGENCY_TONE_HZ, seconds=EMERGENCY_TONE_S, framerate=16000, volume=0.8):
+    # 几段交替的正弦音组成的 16 位单声道 wav 数据
+    samples = array.array('h')
+    count = int(framerate * seconds / len(frequencies))
+    for frequency in frequencies:
+        step = 2 * math.pi * frequency / framerate
+        samples.extend(int(32767 * volume * math.sin(i * step)) for i in range(count))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(framerate)
+        w.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+class EmergencyChannel:
+    # 没有可用的播放器时（比如 Linux 上没装 aplay/paplay）放不了警报音和呼救语音文件，
+    # 每一轮都让语音线程用 TTS 说呼救语音，重复逻辑不变
+    def __init__(self, speech, directory, player=None, metrics=None):
+        self.speech = speech
+        self.directory = directory
+        self.player = player
+        self.metrics = metrics or LatencyTracker()
+        self.on_start = None  # 开始出声时在频道线程里回调
+        self.active = False
+        self.triggered_at = None
+        self._tone = alarm_tone()
+        self._clips = {}    # 语言 -> (文件路径, 时长)
+        self._wanted = {}   # 语言 -> (文字, 语音ID)
+        self._language = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._ack = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="EmergencyChannel", daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._tone_clip = self._store("tone.wav", self._tone)
+        self._thread.start()
+
+    def shutdown(self):
+        self._closed = True
+        self._ack.set()
+        self._wake.set()
+
+    def prepare(self, lang, text, voice_id):
+        # 让语音线程优先把这种语言的呼救语音合成进缓存，频道线程空闲时取走
+        with self._lock:
+            self._wanted[lang] = (text, voice_id)
+        if self.ready(lang):
+            return
+        self.speech.prefetch(text, voice_id, EMERGENCY_RATE, 1.0, priority=PRIORITY_SPECULATIVE)
+
+    def ready(self, lang):
+        clip = self._clips.get(lang)
+        return clip is not None and clip[2] == self._wanted.get(lang)
+
+    def trigger(self, lang):
+        with self._lock:
+            self._language = lang
+            if self.active:
+                return False
+            self.active = True
+            self.triggered_at = time.perf_counter()
+            self._ack.clear()
+        # 先唤醒频道再停语音：播放器只停语音线程自己开始的声音，已经响起的警报音不受影响
+        self._wake.set()
+        self.speech.suspend()
+        return True
+
+    def acknowledge(self):
+        # 返回警报响了多少秒；没有在响时返回 None
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._ack.set()
+        # 用 TTS 说的呼救语音也要停下
+        self.speech.interrupt(flush=True)
+        self.speech.resume()
+        return time.perf_counter() - self.triggered_at
+
+    def _run(self):
+        while not self._closed:
+            if not self._wake.wait(EMERGENCY_RELOAD_S):
+                self._load_clips()
+                continue
+            self._wake.clear()
+            if self.active:
+                try:
+                    self._sound()
+                except Exception as e:
+                    print(f"Emergency alarm error: {e}")
+
+    def _sound(self):
+        first = True
+        while self.active and not self._closed:
+            handle = self.player.start(self._tone_clip[0]) if self._can_play() else None
+            if first:
+                first = False
+                self.metrics.observe('emergency_start', (time.perf_counter() - self.triggered_at) * 1000)
+                if self.on_start is not None:
+                    try: self.on_start()
+                    except Exception: pass
+            # 警报音响起之后再去缓存里取呼救语音（可能要等缓存的锁）；
+            # 换了语音后新的呼救语音还没合成好时，先用旧的
+            if handle is not None and not self.ready(self._language):
+                self._load_clips()
+            if handle is not None:
+                self.player.wait(handle, self._ack)
+            if not self.active:
+                break
+            clip = self._clips.get(self._language)
+            if clip is not None and handle is not None:
+                self.player.play(clip[0], self._ack)
+            else:
+                self._say()
+            self._ack.wait(EMERGENCY_REPEAT_GAP_S)
+
+    def _say(self):
+        # 呼救语音还没合成好或者放不了：让语音线程用 TTS 说，说完（或确认、超时）再重复警报音，免得两者叠在一起
+        text, voice_id = self._wanted.get(self._language, (None, None))
+        if text is None:
+            return
+        done = threading.Event()
+        self.speech.speak(text, PRIORITY_EMERGENCY, voice_id=voice_id, rate=EMERGENCY_RATE, volume=1.0, done=done)
+        deadline = time.monotonic() + EMERGENCY_SPEECH_TIMEOUT_S
+        while not done.wait(0.05):
+            if not self.active or time.monotonic() > deadline:
+                break
+
+    def _can_play(self):
+        return self.player is not None and self.player.available
+
+    def _store(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return path, wav_duration(path)
+
+    def _load_clips(self):
+        cache = self.speech.cache
+        if cache is None:
+            return
+        with self._lock:
+            wanted = dict(self._wanted)
+        for lang, (text, voice_id) in wanted.items():
+            if self.ready(lang):
+                continue
+            path = cache.get(text, voice_id, EMERGENCY_RATE, 1.0)
+            if path is None:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self._clips[lang] = self._store(f"message_{lang}.wav", data) + ((text, voice_id),)
+            except OSError as e:
+                print(f"Emergency clip error: {e}")
+
+
+# --- 语言包 ---
+# locales/<语言>.json：{"ui": {界面文字}, "categories": {分类: 名称}, "vocabulary": {词条ID: 文字}}
+# 启动时只列出有哪些语言，某种语言第一次用到时才读入文件，之后一直缓存
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+DEFAULT_LANGUAGE = 'en'  # 其他语言包缺少的文字用这种语言补上
+
+
+class LocaleStore:
+    def __init__(self, directory=LOCALES_DIR):
+        self.directory = directory
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+        self.languages = sorted(name[:-5] for name in names if name.endswith(".json"))
+        self._packs = {}
+        self._lock = threading.RLock()
+
+    def pack(self, lang):
+        pack = self._packs.get(lang)
+        if pack is None:
+            with self._lock:
+                pack = self._packs.get(lang)
+                if pack is None:
+                    pack = self._packs[lang] = self._load(lang)
+        return pack
+
+    def _load(self, lang):
+        try:
+            with open(os.path.join(self.directory, lang + ".json"), encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Locale error ({lang}): {e}")
+            data = {}
+        pack = {'ui': data.get('ui', {}), 'categories': data.get('categories', {}), 'vocabulary': data.get('vocabulary', {})}
+        if lang != DEFAULT_LANGUAGE and DEFAULT_LANGUAGE in self.languages:
+            pack['ui'] = dict(self.pack(DEFAULT_LANGUAGE)['ui'], **pack['ui'])
+        return pack
+
+    def loaded(self):
+        return list(self._packs)
+
+    def ui(self, lang):
+        return self.pack(lang)['ui']
+
+    def next_language(self, lang):
+        # 按文件名顺序循环切换
+        if lang not in self.languages:
+            return self.languages[0] if self.languages else lang
+        return self.languages[(self.languages.index(lang) + 1) % len(self.languages)]
+
+
+# --- 词汇库 ---
+VOCABULARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vocabulary.json")
+
+
+class VocabEntry:
+    # 紧凑的词条：只存与语言无关的部分，文字通过 store 从语言包按 ID 取（字符串已 intern）
+    # 支持 entry['en'] / entry['emoji'] 这样的字典式读取，和手动输入的词条用法一致
+    # image 是可选的图片符号（PNG 路径），有图片时显示图片而不是表情
+    __slots__ = ('id', 'category', 'emoji', 'image', 'store')
+
+    def __init__(self, item_id, category, emoji, image, store):
+        self.id = item_id
+        self.category = category
+        self.emoji = emoji
+        self.image = image
+        self.store = store
+
+    def text(self, lang):
+        return self.store.text(self.id, lang)
+
+    def __getitem__(self, key):
+        if key in ('id', 'category', 'emoji', 'image'):
+            return getattr(self, key)
+        if key in self.store.languages:
+            return self.store.text(self.id, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ('id', 'category', 'emoji', 'image') or key in self.store.languages
+
+    def __repr__(self):
+        return f"VocabEntry({self.id}, {self.category!r}, {self.emoji!r})"
+
+
+class VocabularyStore:
+    # 数据文件格式：{"categories": [{id, icon, color}], "entries": {分类: [[id, emoji], ...]}}，文字在语言包里；
+    # 也可以直接带文字：{"languages": [...], "entries": {分类: [[id, emoji, 文字...], ...]}}，分类带 "labels"。
+    # 可选的 "images": {id: 图片路径}（相对于数据文件）给词条换成图片符号。
+    # 词条对象按分类在第一次访问时才创建，每种语言的文字表、ID 索引和文字索引也在第一次查询时才建立
+    def __init__(self, path, locales=None):
+        self.path = path
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.locales = locales or LocaleStore()
+        self._embedded = tuple(data.get('languages', ()))
+        self.languages = tuple(self._embedded) + tuple(l for l in self.locales.languages if l not in self._embedded)
+        self.categories = data['categories']
+        self._rows = data['entries']
+        base = os.path.dirname(os.path.abspath(path))
+        self._images = {int(k): os.path.join(base, v) for k, v in data.get('images', {}).items()}
+        self._texts = {}
+        self._by_category = {}
+        self._by_id = None
+        self._by_text = {}
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._rows.values())
+
+    def __iter__(self):
+        for cat_id in self._rows:
+            yield from self.by_category(cat_id)
+
+    def by_category(self, cat_id):
+        entries = self._by_category.get(cat_id)
+        if entries is None:
+            intern = sys.intern
+            category = intern(cat_id)
+            images = self._images
+            entries = [VocabEntry(row[0], category, intern(row[1]), images.get(row[0]), self)
+                       for row in self._rows.get(cat_id, ())]
+            self._by_category[cat_id] = entries
+        return entries
+
+    def text(self, item_id, lang):
+        texts = self._texts.get(lang)
+        if texts is None:
+            texts = self._texts[lang] = self._load_texts(lang)
+        text = texts.get(item_id)
+        if text is None:
+            # 语言包里没有翻译的词用默认语言显示
+            text = self.text(item_id, DEFAULT_LANGUAGE) if lang != DEFAULT_LANGUAGE else ""
+        return text
+
+    def _load_texts(self, lang):
+        intern = sys.intern
+        if lang in self._embedded:
+            column = 2 + self._embedded.index(lang)
+            return {row[0]: intern(row[column]) for rows in self._rows.values() for row in rows}
+        if lang not in self.locales.languages:
+            return {}
+        return {int(k): intern(v) for k, v in self.locales.pack(lang)['vocabulary'].items()}
+
+    def label(self, cat, lang):
+        # 分类名称：数据文件自带的优先，其次是语言包
+        labels = cat.get('labels')
+        if labels and lang in labels:
+            return labels[lang]
+        if lang in self.locales.languages:
+            return self.locales.pack(lang)['categories'].get(cat['id'], cat['id'])
+        return cat['id']
+
+    def by_id(self, item_id):
+        if self._by_id is None:
+            self._by_id = {entry.id: entry for entry in self}
+        return self._by_id.get(item_id)
+
+    def find_text(self, text, lang):
+        index = self._by_text.get(lang)
+        if index is None:
+            index = {}
+            for entry in self:
+                index.setdefault(entry.text(lang).casefold(), entry)
+            self._by_text[lang] = index
+        return index.get(text.strip().casefold())
+
+
+# 句子条中单个词块最多显示的字符数，更长的手动输入会被截断显示
+MAX_CHIP_CHARS = 30
+
+# --- 句子扩展 ---
+EXPANSION_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "expansion_rules.json")
+
+
+class ExpansionEngine:
+    # 规则表按语言编译成查找表：(最后分类, 最后一个词) -> 规则，最后分类 -> 规则，词集合规则依次检查。
+    # 规则按表中顺序排名：第一条匹配的规则给出首选结果，之后匹配的规则和默认模板作为备选。
+    # 模板占位符：{text} 整句，{last} 最后一个词，{content_last} 去掉触发词后的最后一个词
+    MEMO_SIZE = 4096
+
+    def __init__(self, path):
+        with open(path, encoding='utf-8') as f:
+            spec = json.load(f)
+        self._tables = {lang: self._compile(lang_spec) for lang, lang_spec in spec.items()}
+        self._memo = {}
+
+    @staticmethod
+    def _compile(spec):
+        table = {'rules': spec.get('rules', []), 'default': spec.get('default', ["{text}"]),
+                 'by_word': {}, 'by_category': {}, 'word_sets': []}
+        for index, rule in enumerate(table['rules']):
+            cats = rule.get('category')
+            if isinstance(cats, str):
+                cats = [cats]
+            if 'any_word' in rule or 'all_words' in rule:
+                words = frozenset(w.casefold() for w in rule.get('any_word') or rule.get('all_words'))
+                table['word_sets'].append((index, 'any_word' in rule, words, frozenset(cats) if cats else None))
+            elif 'words' in rule:
+                for cat in cats or [None]:
+                    for word in rule['words']:
+                        table['by_word'].setdefault((cat, word.casefold()), []).append(index)
+            else:
+                for cat in cats or [None]:
+                    table['by_category'].setdefault(cat, []).append(index)
+        return table
+
+    def languages(self):
+        return list(self._tables)
+
+    def fixed_phrases(self, lang):
+        # 不含占位符的模板，可以提前合成语音
+        table = self._tables.get(lang)
+        if table is None:
+            return []
+        phrases = []
+        for rule in table['rules']:
+            for tpl in rule['templates'] + rule.get('empty', []):
+                if '{' not in tpl and tpl not in phrases:
+                    phrases.append(tpl)
+        return phrases
+
+    def expand(self, sentence, lang):
+        words = []
+        last_category = 'other'
+        last = ""
+        for item in sentence:
+            if 'manual_text' in item:
+                words.append(item['manual_text'])
+                last_category = 'manual'
+                last = item['manual_text']
+            else:
+                words.append(item[lang])
+                last_category = item['category']
+                last = item[lang].lower()
+
+        signature = (lang, last_category, tuple(words))
+        cached = self._memo.get(signature)
+        if cached is None:
+            cached = self._expand(words, last_category, last, lang)
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            self._memo[signature] = cached
+        return list(cached)
+
+    def _expand(self, words, last_category, last, lang):
+        text = " ".join(words)
+        table = self._tables.get(lang)
+        if table is None:
+            return (text,)
+        folded = [w.casefold() for w in words]
+        word_set = set(folded)
+        last_key = folded[-1] if folded else ""
+
+        matches = set()
+        for cat in (last_category, None):
+            matches.update(table['by_word'].get((cat, last_key), ()))
+            matches.update(table['by_category'].get(cat, ()))
+        word_rules = {}
+        for index, any_mode, rule_words, cats in table['word_sets']:
+            if cats is not None and last_category not in cats:
+                continue
+            if (any_mode and not word_set.isdisjoint(rule_words)) or (not any_mode and rule_words <= word_set):
+                matches.add(index)
+                word_rules[index] = rule_words
+
+        candidates = []
+        values = {'text': text, 'last': last, 'content_last': last}
+        for index in sorted(matches):
+            rule = table['rules'][index]
+            templates = rule['templates']
+            if index in word_rules and 'any_word' in rule:
+                content = [w for w, f in zip(words, folded) if f not in word_rules[index]]
+                if not content:
+                    templates = rule.get('empty', [])
+                else:
+                    values = dict(values, content_last=content[-1].lower())
+            for tpl in templates:
+                phrase = tpl.format(**values)
+                if phrase not in candidates:
+                    candidates.append(phrase)
+        for tpl in table['default']:
+            phrase = tpl.format(**values)
+            if phrase not in candidates:
+                candidates.append(phrase)
+        return tuple(candidates)
+
+
+class SpeculativeExpander:
+    # 用户每次改动句子时在后台预先计算扩展句并预合成首选结果的语音；
+    # 句子再次变化时代数加一，进行中或排队的旧任务都会被作废
+    def __init__(self, expander, speech):
+        self.expander = expander
+        self.speech = speech
+        self._lock = threading.Lock()
+        self._gen = 0
+        self._result = None
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="SpeculativeExpander", daemon=True)
+            self._thread.start()
+
+    def shutdown(self):
+        self.cancel()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def submit(self, sentence, lang, voice_id, rate):
+        with self._lock:
+            self._gen += 1
+            self._result = None
+            gen = self._gen
+        self.speech.cancel_stale()
+        if sentence:
+            self._queue.put((gen, list(sentence), lang, voice_id, rate))
+
+    def cancel(self):
+        with self._lock:
+            self._gen += 1
+            self._result = None
+        self.speech.cancel_stale()
+
+    def result_for(self, sentence, lang):
+        with self._lock:
+            result = self._result
+        if result and result['lang'] == lang and result['items'] == sentence:
+            return result['candidates']
+        return None
+
+    def _is_current(self, gen):
+        return gen == self._gen
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            gen, items, lang, voice_id, rate = job
+            if not self._is_current(gen):
+                continue
+            try:
+                candidates = self.expander.expand(items, lang)
+            except Exception as e:
+                print(f"Expansion error: {e}")
+                continue
+            with self._lock:
+                if gen != self._gen:
+                    continue
+                self._result = {'lang': lang, 'items': items, 'candidates': candidates}
+            self.speech.prefetch(candidates[0], voice_id, rate, priority=PRIORITY_SPECULATIVE,
+                                 is_current=lambda g=gen: self._is_current(g))
+
+
+# --- 下一个词预测 ---
+PREDICTION_FILE = os.path.join(APP_DATA_DIR, "prediction.json")
+PREDICTION_ORDER = 3   # 最多用前两个词作上下文
+PREDICTION_COUNT = 6   # 预测栏显示的词卡数
+
+
+def sentence_tokens(sentence):
+    # 词库词条用 ID 表示，手动输入用文字表示，与界面语言无关
+    return ["t:" + item['manual_text'] if 'manual_text' in item else "v:%d" % item['id'] for item in sentence]
+
+
+class PredictionModel:
+    # 从用户实际说出的句子里学习 n-gram 次数：每个词 O(1) 更新，预测时从长上下文回退到短上下文
+    START = "<s>"
+
+    def __init__(self, path=None):
+        self.path = path
+        self.counts = {}  # 上下文元组 -> {下一个词: 次数}
+        self.manual = {}  # 手动输入过的文字 -> 次数
+        self.dirty = 0
+        if path:
+            self.load()
+
+    def learn(self, tokens):
+        history = (self.START,) * (PREDICTION_ORDER - 1)
+        for token in tokens:
+            for n in range(PREDICTION_ORDER):
+                bucket = self.counts.setdefault(history[len(history) - n:] if n else (), {})
+                bucket[token] = bucket.get(token, 0) + 1
+            history = history[1:] + (token,)
+        self.dirty += 1
+
+    def note_manual(self, text):
+        self.manual[text] = self.manual.get(text, 0) + 1
+        self.dirty += 1
+        return self.manual[text]
+
+    def count(self, token):
+        return self.counts.get((), {}).get(token, 0)
+
+    def predict(self, tokens, k=PREDICTION_COUNT):
+        history = ((self.START,) * (PREDICTION_ORDER - 1) + tuple(tokens))[-(PREDICTION_ORDER - 1):]
+        result = []
+        for n in range(PREDICTION_ORDER - 1, -1, -1):
+            bucket = self.counts.get(history[len(history) - n:] if n else ())
+            if not bucket:
+                continue
+            for token, _ in heapq.nlargest(k, bucket.items(), key=lambda kv: kv[1]):
+                if token not in result:
+                    result.append(token)
+                    if len(result) == k:
+                        return result
+        return result
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.counts = {tuple(ctx): bucket for ctx, bucket in data.get('counts', [])}
+        self.manual = data.get('manual', {})
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        data = {'order': PREDICTION_ORDER, 'counts': [[list(ctx), bucket] for ctx, bucket in self.counts.items()],
+                'manual': self.manual}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(self.path + ".tmp", self.path)
+            self.dirty = 0
+        except OSError as e:
+            print(f"Prediction save error: {e}")
+
+
+class PrefixTrie:
+    # 前缀树：每个节点缓存该前缀下权重最高的若干补全，查询只需沿前缀走一遍
+    TOP = 8
+
+    def __init__(self):
+        self.root = ({}, [])  # (子节点, [(权重, 文字, 附带数据)])
+
+    def insert(self, text, payload=None, weight=1):
+        entry = (weight, text, payload)
+        node = self.root
+        self._offer(node, entry)
+        for ch in text.casefold():
+            node = node[0].setdefault(ch, ({}, []))
+            self._offer(node, entry)
+
+    def _offer(self, node, entry):
+        top = [e for e in node[1] if e[1] != entry[1]]
+        top.append(entry)
+        top.sort(key=lambda e: -e[0])
+        node[1][:] = top[:self.TOP]
+
+    def complete(self, prefix, k=PREDICTION_COUNT):
+        node = self.root
+        for ch in prefix.casefold():
+            node = node[0].get(ch)
+            if node is None:
+                return []
+        return [(text, payload) for _, text, payload in node[1][:k]]
+
+
+# --- 常用句库 ---
+# 说过的整句和扩展句连同使用次数存起来，之后搜索一下点一次就能再说。
+# 搜索用字符三元组倒排索引：所有三元组都命中的短语够多时只用它们，否则从最少见的几个三元组取候选
+# （允许约三分之一的三元组对不上，容忍错字），再按覆盖率、前缀/子串命中和使用次数排序。
+# 不足三个字的查询直接在规范化文字里找子串
+PHRASE_RESULTS = 8
+PHRASE_FUZZY = 3            # 允许 1/PHRASE_FUZZY 的三元组不匹配
+PHRASE_MAX_CANDIDATES = 500   # 模糊匹配时最多检查的候选
+PHRASE_SCORED = 200           # 最多给这么多条结果打分（按常用程度取）
+_PHRASE_STRIP = re.compile(r'[\W_]+')
+
+
+def normalize_phrase(text):
+    return _PHRASE_STRIP.sub(' ', text.casefold()).strip()
+
+
+def phrase_grams(norm):
+    padded = " " + norm
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class PhraseBank:
+    def __init__(self, path=None):
+        self.path = path
+        self.phrases = []   # [文字, 语言, 次数, 最后使用时间]
+        self.dirty = 0
+        self._norms = []
+        self._ids = {}      # (语言, 规范化文字) -> 序号
+        self._index = None  # 三元组 -> {序号}，第一次搜索时才建立
+        self._rank = None
+        self._loaded = not path  # 文件在第一次使用时才读
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self.phrases)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._loaded = True
+            self.load()
+
+    def add(self, text, lang, count=1):
+        self._ensure_loaded()
+        text = text.strip()
+        norm = normalize_phrase(text)
+        if not norm:
+            return None
+        pid = self._ids.get((lang, norm))
+        known = pid is not None
+        if not known:
+            pid = len(self.phrases)
+            self.phrases.append([text, lang, 0, 0])
+            self._norms.append(norm)
+            self._ids[(lang, norm)] = pid
+            if self._index is not None:
+                self._index_phrase(pid, norm)
+        phrase = self.phrases[pid]
+        if self._rank is not None and known:
+            self._rank.remove(pid)
+        phrase[2] += count
+        phrase[3] = int(time.time())
+        if self._rank is not None:
+            self._rerank(pid)
+        self.dirty += 1
+        return pid
+
+    def _rerank(self, pid):
+        # 排名已经建好时只把这一条二分插回去，不整体重排
+        rank, phrases = self._rank, self.phrases
+        key = (phrases[pid][2], phrases[pid][3])
+        lo, hi = 0, len(rank)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            other = phrases[rank[mid]]
+            if (other[2], other[3]) > key:
+                lo = mid + 1
+            else:
+                hi = mid
+        rank.insert(lo, pid)
+
+    def _index_phrase(self, pid, norm):
+        for gram in phrase_grams(norm):
+            postings = self._index.get(gram)
+            if postings is None:
+                postings = self._index[gram] = set()
+            postings.add(pid)
+
+    def _ensure_index(self):
+        if self._index is None:
+            self._index = {}
+            for pid, norm in enumerate(self._norms):
+                self._index_phrase(pid, norm)
+        return self._index
+
+    def _popular(self):
+        # 按使用次数（再按最近使用）排好的序号，候选太多时只看最常用的那些
+        if self._rank is None:
+            phrases = self.phrases
+            self._rank = sorted(range(len(phrases)), key=lambda pid: (phrases[pid][2], phrases[pid][3]), reverse=True)
+        return self._rank
+
+    def _most_popular(self, pids, limit):
+        if len(pids) <= limit:
+            return list(pids)
+        picked = []
+        for pid in self._popular():
+            if pid in pids:
+                picked.append(pid)
+                if len(picked) == limit:
+                    break
+        return picked
+
+    def search(self, query, k=PHRASE_RESULTS, lang=None):
+        # 返回 [(文字, 语言, 次数)]；lang 是当前语言，同分时优先。空查询返回最常用的
+        self._ensure_loaded()
+        q = normalize_phrase(query)
+        phrases, norms = self.phrases, self._norms
+        if not q:
+            return [tuple(phrases[pid][:3]) for pid in self._popular()[:k]]
+        coverage = {}
+        if len(q) >= 3:
+            index = self._ensure_index()
+            grams = phrase_grams(q)
+            postings = sorted((index.get(g, ()) for g in grams), key=len)
+            exact = set(postings[0]).intersection(*postings[1:]) if postings[0] else set()
+            if len(exact) >= k:
+                pool = self._most_popular(exact, PHRASE_SCORED)
+            else:
+                # 最多漏掉 tolerance 个三元组的短语，一定出现在最少见的 tolerance+1 个三元组里
+                tolerance = len(grams) // PHRASE_FUZZY
+                candidates = set().union(*postings[:tolerance + 1])
+                pool = []
+                for pid in itertools.islice(candidates, PHRASE_MAX_CANDIDATES):
+                    matched = sum(1 for p in postings if pid in p)
+                    if matched >= len(grams) - tolerance:
+                        coverage[pid] = matched / len(grams)
+                        pool.append(pid)
+        else:
+            # 短查询：按常用程度直接找子串，找够就停
+            pool = []
+            for pid in self._popular():
+                if q in norms[pid]:
+                    pool.append(pid)
+                    if len(pool) == PHRASE_SCORED:
+                        break
+
+        def score(pid):
+            norm = norms[pid]
+            bonus = 0.5 if norm.startswith(q) else 0.25 if q in norm else 0.0
+            return (coverage.get(pid, 1.0) + bonus + 0.1 * math.log1p(phrases[pid][2]) + (0.05 if phrases[pid][1] == lang else 0.0),
+                    phrases[pid][3])
+        return [tuple(phrases[pid][:3]) for pid in heapq.nlargest(k, pool, key=score)]
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        for text, lang, count, last_used in data.get('phrases', []):
+            pid = self.add(text, lang, count)
+            if pid is not None:
+                self.phrases[pid][3] = last_used
+        self.dirty = 0
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump({'phrases': self.phrases}, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(self.path + ".tmp", self.path)
+            self.dirty = 0
+        except OSError as e:
+            print(f"Phrase bank save error: {e}")
+
+
+# --- 虚拟化词卡网格 ---
+# 分类词汇超过该数量时改用画布绘制的虚拟网格
+VIRTUAL_GRID_THRESHOLD = 120
+
+
+class VirtualGrid:
+    # 只把视口内可见的词卡画成画布图元，滚动时回收复用，点击按坐标反查词卡
+    def __init__(self, canvas, on_tap, label_for, columns=4, card_w=150, card_h=110, gap=16, image_for=None):
+        self.canvas = canvas
+        self.on_tap = on_tap
+        self.label_for = label_for
+        self.image_for = image_for  # 返回词卡符号图片（没有时返回 None，按文字画表情）
+        self.columns = columns
+        self.card_w = card_w
+        self.card_h = card_h
+        self.gap = gap
+        self.items = []
+        self.active = False
+        self._visible = {}  # 词卡序号 -> (矩形, 表情, 图片, 文字) 图元
+        self._images = {}   # 词卡序号 -> 正在显示的 PhotoImage（保持引用）
+        self._pool = []
+        self._rows = None
+        canvas.bind("<Button-1>", self._on_click, add="+")
+
+    def show(self, items):
+        self.items = items
+        self.active = True
+        self.redraw()
+
+    def hide(self):
+        self.active = False
+        for index in list(self._visible):
+            self._release(index)
+        self._rows = None
+
+    def redraw(self):
+        for index in list(self._visible):
+            self._release(index)
+        self._rows = None
+        self.refresh()
+
+    def scrollregion(self):
+        rows = (len(self.items) + self.columns - 1) // self.columns
+        width = self.columns * (self.card_w + self.gap) + self.gap
+        return (0, 0, width, rows * (self.card_h + self.gap) + self.gap)
+
+    def refresh(self):
+        if not self.active:
+            return
+        pitch = self.card_h + self.gap
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        rows = (max(0, int(top // pitch)), int(bottom // pitch))
+        if rows == self._rows:
+            return
+        self._rows = rows
+        first = rows[0] * self.columns
+        last = min(len(self.items), (rows[1] + 1) * self.columns)
+        for index in list(self._visible):
+            if not first <= index < last:
+                self._release(index)
+        for index in range(first, last):
+            if index not in self._visible:
+                self._draw(index)
+
+    def _draw(self, index):
+        if self._pool:
+            ids = self._pool.pop()
+        else:
+            ids = (self.canvas.create_rectangle(0, 0, 0, 0, fill="white", outline="#94a3b8", tags=("vgrid",)),
+                   self.canvas.create_text(0, 0, font=("Segoe UI Emoji", 32), tags=("vgrid",)),
+                   self.canvas.create_image(0, 0, tags=("vgrid",)),
+                   self.canvas.create_text(0, 0, font=("Arial", 12, "bold"), fill="#1e293b", tags=("vgrid",)))
+        item = self.items[index]
+        x = self.gap + (index % self.columns) * (self.card_w + self.gap)
+        y = self.gap + (index // self.columns) * (self.card_h + self.gap)
+        rect, emoji, picture, text = ids
+        self.canvas.coords(rect, x, y, x + self.card_w, y + self.card_h)
+        self.canvas.coords(emoji, x + self.card_w / 2, y + self.card_h * 0.38)
+        self.canvas.coords(picture, x + self.card_w / 2, y + self.card_h * 0.38)
+        self.canvas.coords(text, x + self.card_w / 2, y + self.card_h * 0.8)
+        image = self.image_for(item) if self.image_for else None
+        if image is not None:
+            self._images[index] = image
+        self.canvas.itemconfigure(picture, image=image if image is not None else "")
+        self.canvas.itemconfigure(emoji, text="" if image is not None else item['emoji'])
+        self.canvas.itemconfigure(text, text=self.label_for(item))
+        for i in ids:
+            self.canvas.itemconfigure(i, state='normal')
+        self._visible[index] = ids
+
+    def _release(self, index):
+        ids = self._visible.pop(index)
+        self._images.pop(index, None)
+        for i in ids:
+            self.canvas.itemconfigure(i, state='hidden')
+        self._pool.append(ids)
+
+    def _on_click(self, event):
+        if not self.active:
+            return
+        x = self.canvas.canvasx(event.x) - self.gap
+        y = self.canvas.canvasy(event.y) - self.gap
+        if x < 0 or y < 0:
+            return
+        col, col_off = divmod(x, self.card_w + self.gap)
+        row, row_off = divmod(y, self.card_h + self.gap)
+        if col >= self.columns or col_off > self.card_w or row_off > self.card_h:
+            return
+        index = int(row) * self.columns + int(col)
+        if index < len(self.items):
+            self.on_tap(self.items[index])
+
+
+# --- 符号图片缓存 ---
+# 彩色表情（尤其是 👩‍🏫 这种多码点序列）每次用字体绘制都很慢：每个符号每种尺寸只栅格化一次，
+# PNG 存在磁盘上，内存里保留最近用过的 PhotoImage。没有 PIL 时表情仍按文字绘制，图片符号用 Tk 自己缩放
+GLYPH_CARD_SIZE = 48
+GLYPH_CHIP_SIZE = 20
+GLYPH_CACHE_SIZE = 512
+GLYPH_FONTS = (
+    "seguiemj.ttf",
+    "/System/Library/Fonts/Apple Color Emoji.ttc",
+    "/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf",
+    "/usr/share/fonts/noto/NotoColorEmoji.ttf",
+    "NotoColorEmoji.ttf",
+)
+GLYPH_FONT_SIZES = (109, 160, 64)  # 彩色位图字体只支持固定字号
+
+
+class GlyphCache:
+    def __init__(self, directory, max_images=GLYPH_CACHE_SIZE):
+        self.directory = directory
+        self.max_images = max_images
+        self._images = OrderedDict()  # (符号, 图片, 尺寸) -> PhotoImage，最久未用的在前
+        self._failed = set()
+        self._font = None
+        os.makedirs(directory, exist_ok=True)
+
+    def image(self, symbol, size, picture=None):
+        # 返回 PhotoImage；无法生成时返回 None，由调用方退回文字绘制。
+        # 被淘汰的图片只要控件还引用着就不会消失，调用方需要保留引用（label.image = ...）
+        if picture is None and Image is None:
+            return None
+        key = (symbol, picture, size)
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            return image
+        if key in self._failed:
+            return None
+        try:
+            image = self._load(symbol, size, picture)
+        except (OSError, ValueError, tk.TclError) as e:
+            print(f"Glyph error ({picture or symbol}): {e}")
+            image = None
+        if image is None:
+            self._failed.add(key)
+            return None
+        self._images[key] = image
+        if len(self._images) > self.max_images:
+            self._images.popitem(last=False)
+        return image
+
+    def _load(self, symbol, size, picture):
+        source = [picture, os.path.getmtime(picture)] if picture else [symbol]
+        name = hashlib.sha1(json.dumps(source + [size], ensure_ascii=False).encode('utf-8')).hexdigest()
+        path = os.path.join(self.directory, name + ".png")
+        if not os.path.exists(path):
+            if picture:
+                self._rasterize_picture(picture, size, path)
+            elif not self._rasterize_emoji(symbol, size, path):
+                return None
+        return tk.PhotoImage(file=path)
+
+    def _rasterize_picture(self, picture, size, path):
+        if Image is None:
+            photo = tk.PhotoImage(file=picture)
+            factor = -(-max(photo.width(), photo.height()) // size)
+            if factor > 1:
+                photo = photo.subsample(factor)
+            photo.write(path + ".tmp", format="png")
+        else:
+            with Image.open(picture) as img:
+                self._square(img.convert("RGBA"), size).save(path + ".tmp", format="PNG")
+        os.replace(path + ".tmp", path)
+
+    def _rasterize_emoji(self, symbol, size, path):
+        font = self._emoji_font()
+        if font is None:
+            return False
+        box = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox((0, 0), symbol, font=font, embedded_color=True)
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return False
+        img = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+        ImageDraw.Draw(img).text((-box[0], -box[1]), symbol, font=font, embedded_color=True)
+        self._square(img, size).save(path + ".tmp", format="PNG")
+        os.replace(path + ".tmp", path)
+        return True
+
+    @staticmethod
+    def _square(img, size):
+        img.thumbnail((size, size), Image.LANCZOS)
+        out = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        out.paste(img, ((size - img.width) // 2, (size - img.height) // 2), img)
+        return out
+
+    def _emoji_font(self):
+        if self._font is None:
+            self._font = False
+            for path in GLYPH_FONTS:
+                for font_size in GLYPH_FONT_SIZES:
+                    try:
+                        self._font = ImageFont.truetype(path, font_size)
+                        break
+                    except OSError:
+                        continue
+                if self._font:
+                    break
+        return self._font or None
+
+
+# --- 测试用语音引擎 ---
+class FakeTTSEngine:
+    # 模拟 pyttsx3 引擎接口，用于基准测试：不发声，按设定的耗时模拟初始化和逐词朗读
+    def __init__(self, init_delay=0.0, word_time=0.0):
+        time.sleep(init_delay)
+        self.word_time = word_time
+        self.props = {'rate': 150, 'volume': 1.0, 'voice': 'fake-en'}
+        self.callbacks = {}
+        self.pending = []
+        self.stopped = False
+        self.voices = [
+            types.SimpleNamespace(id='fake-en', name='Fake English', languages=['en']),
+            types.SimpleNamespace(id='fake-zh', name='Fake Chinese', languages=['zh']),
+        ]
+
+    def connect(self, name, callback):
+        self.callbacks.setdefault(name, []).append(callback)
+
+    def setProperty(self, name, value):
+        self.props[name] = value
+
+    def getProperty(self, name):
+        if name == 'voices':
+            return self.voices
+        return self.props.get(name)
+
+    def say(self, text, name=None):
+        self.pending.append(('say', text, None))
+
+    def save_to_file(self, text, path, name=None):
+        self.pending.append(('file', text, path))
+
+    def stop(self):
+        self.stopped = True
+
+    def _fire(self, name, *args):
+        for callback in self.callbacks.get(name, []):
+            callback(*args)
+
+    def runAndWait(self):
+        self.stopped = False
+        pending, self.pending = self.pending, []
+        for kind, text, path in pending:
+            if kind == 'file':
+                # 每个词约 0.3 秒的静音
+                with wave.open(path, 'wb') as w:
+                    w.setnchannels(1)
+                    w.setsampwidth(2)
+                    w.setframerate(8000)
+                    w.writeframes(b'\0\0' * 2400 * max(1, len(text.split())))
+                continue
+            self._fire('started-utterance', None)
+            for i, word in enumerate(text.split()):
+                self._fire('started-word', None, i, len(word))
+                if self.stopped:
+                    break
+                if self.word_time:
+                    time.sleep(self.word_time)
+            self._fire('finished-utterance', None, not self.stopped)
+
+
+class FakePlayer:
+    # 模拟 AudioPlayer 接口，用于基准测试：不发声，按音频时长等待；
+    # start_delay 模拟启动播放器进程的耗时，on_start(path, 时间) 在开始“出声”时回调
+    available = True
+
+    def __init__(self, start_delay=0.0):
+        self.start_delay = start_delay
+        self.on_start = None
+
+    def play(self, path, stop_event):
+        self.wait(self.start(path), stop_event)
+
+    def start(self, path):
+        if self.start_delay:
+            time.sleep(self.start_delay)
+        handle = types.SimpleNamespace(deadline=time.monotonic() + wav_duration(path), stopped=threading.Event())
+        if self.on_start is not None:
+            self.on_start(path, time.perf_counter())
+        return handle
+
+    def wait(self, handle, stop_event):
+        while not handle.stopped.is_set():
+            remaining = handle.deadline - time.monotonic()
+            if remaining <= 0 or stop_event.wait(min(0.01, remaining)):
+                break
+
+    def stop(self, handle):
+        handle.stopped.set()
+
+
+# --- 核心模型（与界面无关） ---
+class AACCore:
+    # 句子、分类、语言、语音选择、扩展、预测和语音队列都在这里，不依赖 Tk，可以在无界面环境下运行和测量。
+    # 状态变化通过 listeners 通知界面：listener(region)，region 为 'sentence' / 'category' / 'language' / 'voices'。
+    # post(fn) 用来把后台线程的结果交回核心所属的线程执行（Tk 界面里就是主循环）
+    def __init__(self, engine_factory=None, player=None, data_dir=APP_DATA_DIR,
+                 vocab_path=VOCABULARY_FILE, rules_path=EXPANSION_RULES_FILE, post=None):
+        self.data_dir = data_dir
+        self.post = post or (lambda fn: fn())
+        self.listeners = []
 
         # --- 语言设置 ---
-        self.current_language = 'en'  # 默认为英文
-        
-        # 翻译字典
-        self.translations = {
-            'en': {
-                'title': 'Selftronic AAC',
-                'settings': '⚙️ Settings',
-                'play': '🔊 Play',
-                'ai_btn': '✨ Magic',
-                'delete': '⌫ Del',
-                'clear': '🗑️ Clear',
-                'keyboard': '⌨️ Type',
-                'emergency': '🔔 HELP',
-                'placeholder': 'Click icons or use keyboard...',
-                'ai_thinking': '⏳ Thinking...',
-                'ai_result_title': 'AI Assistant',
-                'ai_result_msg': 'Expanded Result:\n\n“{}”',
-                'cat_people': 'People',
-                'cat_action': 'Action',
-                'cat_food': 'Food',
-                'cat_object': 'Object',
-                'cat_feeling': 'Feeling',
-                'voice_speed': 'Voice Speed',
-                'voice_select': 'Voice Selection',
-                'save': 'Save',
-                'input_title': 'Type Word',
-                'input_msg': 'Please type what you want to say:',
-                'emergency_msg': 'Emergency! I need help immediately!'
-            },
-            'zh': {
-                'title': 'Selftronic AAC',
-                'settings': '⚙️ 设置',
-                'play': '🔊 播放',
-                'ai_btn': '✨ 完整句',
-                'delete': '⌫ 删除',
-                'clear': '🗑️ 清空',
-                'keyboard': '⌨️ 输入',
-                'emergency': '🔔 紧急',
-                'placeholder': '点击图标或使用键盘输入...',
-                'ai_thinking': '⏳ 思考中...',
-                'ai_result_title': 'AI 助手扩展',
-                'ai_result_msg': '扩展结果：\n\n“{}”',
-                'cat_people': '人物',
-                'cat_action': '动作',
-                'cat_food': '食物',
-                'cat_object': '物品',
-                'cat_feeling': '感觉',
-                'voice_speed': '语速调节',
-                'voice_select': '语音选择',
-                'save': '保存',
-                'input_title': '手动输入',
-                'input_msg': '请输入您想说的话：',
-                'emergency_msg': '紧急情况！请帮帮我！'
-            }
-        }
+        # 界面文字、分类名和词汇文字都在语言包里，用到哪种语言才加载哪种
+        self.locales = LocaleStore()
+        self.current_language = DEFAULT_LANGUAGE
 
-        # --- 初始化语音引擎 ---
-        self.engine_init_lock = threading.Lock() 
+        # --- 语音 ---
         self.rate = 150
-        
-        # 预加载语音列表
-        temp_engine = pyttsx3.init()
-        self.voice_list = temp_engine.getProperty('voices')
-        temp_engine.stop()
-        del temp_engine
-
-        # 自动查找最佳的中英文语音ID
-        self.zh_voice_id = None
-        self.en_voice_id = None
-        
-        for voice in self.voice_list:
-            v_name = voice.name.lower()
-            if "zh" in voice.languages or "chinese" in v_name or "sinji" in v_name or "ting-ting" in v_name:
-                if not self.zh_voice_id: self.zh_voice_id = voice.id
-            if "en" in voice.languages or "english" in v_name or "alex" in v_name or "david" in v_name:
-                if not self.en_voice_id: self.en_voice_id = voice.id
-        
-        self.current_voice_id = self.en_voice_id if self.en_voice_id else (self.voice_list[0].id if self.voice_list else None)
+        # 先用磁盘上缓存的语音列表和语言->语音对应关系，完整枚举放到语音线程里在后台进行
+        self.tts_driver = default_tts_driver()
+        self.voice_cache_file = os.path.join(data_dir, "voices.json")
+        voice_cache = load_voice_cache(self.tts_driver, self.voice_cache_file)
+        self._voice_cache_hit = voice_cache is not None
+        self.voice_list = voice_cache['voices'] if voice_cache else []
+        self.language_voices = dict(voice_cache['mapping']) if voice_cache else {}
+        self.voice_inventory_key = voice_cache['key'] if voice_cache else None
+        self.voices_ready = False
+        self.current_voice_id = self.language_voices.get(self.current_language) or (self.voice_list[0]['id'] if self.voice_list else None)
+
+        self.audio_cache = AudioCache(os.path.join(data_dir, "audio_cache"), prerendered=os.path.join(data_dir, PRERENDER_DIR_NAME))
+        # 使用记录（后台批量写盘）和点击到发声各阶段的耗时统计，后者可导出为 JSON
+        self.usage = UsageLog(os.path.join(data_dir, USAGE_LOG_FILE))
+        self.metrics = LatencyTracker(log=self.usage)
+        self.metrics_file = os.path.join(data_dir, "latency.json")
+        self.metrics_export = None  # 设置后关闭时自动导出到该文件
+        self.speech = SpeechService(engine_factory, cache=self.audio_cache, player=player, metrics=self.metrics)
+        self.alarm = EmergencyChannel(self.speech, os.path.join(data_dir, "alarm"), player=player, metrics=self.metrics)
 
         # --- 应用数据 ---
-        self.sentence = [] 
+        self.sentence = []
         self.current_category = 'people'
-        self.is_expanding = False
-
-        # 分类定义
-        self.categories_data = [
-            {'id': 'people', 'label_zh': '人物', 'label_en': 'People', 'icon': '👤', 'color': '#3b82f6'},
-            {'id': 'action', 'label_zh': '动作', 'label_en': 'Action', 'icon': '🎮', 'color': '#22c55e'},
-            {'id': 'food', 'label_zh': '食物', 'label_en': 'Food', 'icon': '☕', 'color': '#f97316'},
-            {'id': 'object', 'label_zh': '物品', 'label_en': 'Object', 'icon': '📦', 'color': '#a855f7'},
-            {'id': 'feeling', 'label_zh': '感觉', 'label_en': 'Feeling', 'icon': '😄', 'color': '#eab308'},
-        ]
 
-        # 词汇数据库 (V1R3 Expanded)
-        self.vocabulary_db = [
-            # People
-            {'id': 101, 'zh': '我', 'en': 'I', 'emoji': '🧑', 'category': 'people'},
-            {'id': 102, 'zh': '爸爸', 'en': 'Dad', 'emoji': '👨', 'category': 'people'},
-            {'id': 103, 'zh': '妈妈', 'en': 'Mom', 'emoji': '👩', 'category': 'people'},
-            {'id': 104, 'zh': '老师', 'en': 'Teacher', 'emoji': '👩‍🏫', 'category': 'people'},
-            {'id': 105, 'zh': '医生', 'en': 'Doctor', 'emoji': '👨‍⚕️', 'category': 'people'},
-            {'id': 106, 'zh': '朋友', 'en': 'Friend', 'emoji': '👫', 'category': 'people'},
-            
-            # Action (Expanded)
-            {'id': 201, 'zh': '想要', 'en': 'Want', 'emoji': '🤲', 'category': 'action'},
-            {'id': 202, 'zh': '吃', 'en': 'Eat', 'emoji': '🍽️', 'category': 'action'},
-            {'id': 203, 'zh': '喝', 'en': 'Drink', 'emoji': '🥤', 'category': 'action'},
-            {'id': 204, 'zh': '去', 'en': 'Go', 'emoji': '🚶', 'category': 'action'},
-            {'id': 205, 'zh': '玩', 'en': 'Play', 'emoji': '🎲', 'category': 'action'},
-            {'id': 206, 'zh': '看', 'en': 'Look', 'emoji': '👀', 'category': 'action'},
-            {'id': 207, 'zh': '帮忙', 'en': 'Help', 'emoji': '🆘', 'category': 'action'},
-            {'id': 208, 'zh': '睡觉', 'en': 'Sleep', 'emoji': '🛌', 'category': 'action'},
-            {'id': 209, 'zh': '跑', 'en': 'Run', 'emoji': '🏃', 'category': 'action'},
-            {'id': 210, 'zh': '画画', 'en': 'Draw', 'emoji': '🎨', 'category': 'action'},
-            {'id': 211, 'zh': '洗澡', 'en': 'Bath', 'emoji': '🛁', 'category': 'action'},
-            {'id': 212, 'zh': '停', 'en': 'Stop', 'emoji': '🛑', 'category': 'action'},
-
-            # Food
-            {'id': 301, 'zh': '水', 'en': 'Water', 'emoji': '💧', 'category': 'food'},
-            {'id': 302, 'zh': '饭', 'en': 'Rice', 'emoji': '🍚', 'category': 'food'},
-            {'id': 303, 'zh': '苹果', 'en': 'Apple', 'emoji': '🍎', 'category': 'food'},
-            {'id': 304, 'zh': '牛奶', 'en': 'Milk', 'emoji': '🥛', 'category': 'food'},
-            {'id': 305, 'zh': '饼干', 'en': 'Cookie', 'emoji': '🍪', 'category': 'food'},
-            {'id': 306, 'zh': '果汁', 'en': 'Juice', 'emoji': '🍹', 'category': 'food'},
-            {'id': 307, 'zh': '面包', 'en': 'Bread', 'emoji': '🍞', 'category': 'food'},
-            
-            # Object
-            {'id': 401, 'zh': '厕所', 'en': 'Toilet', 'emoji': '🚽', 'category': 'object'},
-            {'id': 402, 'zh': '平板', 'en': 'Tablet', 'emoji': '📱', 'category': 'object'},
-            {'id': 403, 'zh': '书', 'en': 'Book', 'emoji': '📖', 'category': 'object'},
-            {'id': 404, 'zh': '床', 'en': 'Bed', 'emoji': '🛏️', 'category': 'object'},
-            {'id': 405, 'zh': '家', 'en': 'Home', 'emoji': '🏠', 'category': 'object'},
-            {'id': 406, 'zh': '公园', 'en': 'Park', 'emoji': '🌳', 'category': 'object'},
-
-            # Feeling (Expanded)
-            {'id': 501, 'zh': '开心', 'en': 'Happy', 'emoji': '😄', 'category': 'feeling'},
-            {'id': 502, 'zh': '难过', 'en': 'Sad', 'emoji': '😢', 'category': 'feeling'},
-            {'id': 503, 'zh': '痛', 'en': 'Pain', 'emoji': '🤕', 'category': 'feeling'},
-            {'id': 504, 'zh': '累', 'en': 'Tired', 'emoji': '😫', 'category': 'feeling'},
-            {'id': 505, 'zh': '好', 'en': 'Good', 'emoji': '👍', 'category': 'feeling'},
-            {'id': 506, 'zh': '不', 'en': 'No', 'emoji': '🙅', 'category': 'feeling'},
-            {'id': 507, 'zh': '生气', 'en': 'Angry', 'emoji': '😠', 'category': 'feeling'},
-            {'id': 508, 'zh': '害怕', 'en': 'Scared', 'emoji': '😱', 'category': 'feeling'},
-            {'id': 509, 'zh': '无聊', 'en': 'Bored', 'emoji': '😐', 'category': 'feeling'},
-            {'id': 510, 'zh': '兴奋', 'en': 'Excited', 'emoji': '🤩', 'category': 'feeling'},
-        ]
+        # 词汇与分类从数据文件加载，按分类/ID/文字建立索引；文件改动后可以 reload_vocabulary()
+        self.vocab_path = vocab_path
+        self.vocab = VocabularyStore(vocab_path, self.locales)
+        self.categories_data = self.vocab.categories
+        self._vocab_stamp = self._vocabulary_stamp()
+        self.expander = ExpansionEngine(rules_path)
+        self.speculator = SpeculativeExpander(self.expander, self.speech)
+        self.predictor = PredictionModel(os.path.join(data_dir, "prediction.json"))
+        self.phrases = PhraseBank(os.path.join(data_dir, "phrases.json"))
+        self._completion_tries = {}
+        self._learned_sentence = None
+
+    def start(self):
+        self.usage.start()
+        self.usage.record('start', self.current_language)
+        self.speech.start()
+        self.speculator.start()
+        self.alarm.start()
+        self._prepare_alarm()
+        self.speech.discover_voices(lambda voices: self.post(lambda: self._on_voices_discovered(voices)))
+        if self._voice_cache_hit:
+            self.prefill_audio_cache()
+
+    def close(self):
+        if self.metrics_export:
+            self.export_metrics(self.metrics_export)
+        self.predictor.save()
+        self.phrases.save()
+        self.speculator.shutdown()
+        self.alarm.shutdown()
+        self.speech.shutdown()
+        self.audio_cache.close()
+        self.usage.close()
+
+    def notify(self, region):
+        for listener in self.listeners:
+            listener(region)
+
+    def t(self, key):
+        return self.strings()[key]
+
+    def strings(self, lang=None):
+        return self.locales.ui(lang or self.current_language)
+
+    def item_text(self, item):
+        # item 可能是普通词汇，也可能是手动输入的文本对象
+        if 'manual_text' in item:
+            return item['manual_text']
+        return item[self.current_language]
+
+    def sentence_text(self):
+        return " ".join(self.item_text(item) for item in self.sentence)
+
+    # --- 句子操作 ---
+    def add(self, item):
+        trace = self.metrics.begin()
+        self.sentence.append(item)
+        self._learned_sentence = None
+        if 'manual_text' in item:
+            self.usage.record('tap', None, 'manual', item['manual_text'])
+        else:
+            self.usage.record('tap', item.id, item.category)
+        # 先把发音放进队列，再通知界面重绘
+        self.speak_text(self.item_text(item), trace=trace)
+        self._speculate()
+        self.notify('sentence')
+
+    def backspace(self):
+        if self.sentence:
+            self.sentence.pop()
+            self._learned_sentence = None
+            self.usage.record('backspace')
+            self._speculate()
+            self.notify('sentence')
+
+    def clear(self):
+        self.sentence = []
+        self._learned_sentence = None
+        self.usage.record('clear')
+        self.speculator.cancel()
+        # 清空同时停止正在说和排队的话
+        self.speech.interrupt(flush=True)
+        self.notify('sentence')
+
+    def set_category(self, cat_id):
+        self.current_category = cat_id
+        self.usage.record('category', cat_id)
+        self.notify('category')
+
+    def toggle_language(self):
+        self.set_language(self.locales.next_language(self.current_language))
+
+    def set_language(self, lang):
+        # 句子保留：词条按 ID 在新语言里取文字，手动输入的保持原样
+        first_use = lang not in self.locales.loaded()
+        self.current_language = lang
+        if not self.language_voices.get(lang) and self.voice_list:
+            voice_id = pick_language_voices(self.voice_list, [lang]).get(lang)
+            if voice_id:
+                self.language_voices[lang] = voice_id
+        if self.language_voices.get(lang):
+            self.current_voice_id = self.language_voices[lang]
+        self._speculate()
+        self._prepare_alarm()
+        self.notify('language')
+        if first_use:
+            self.prefill_audio_cache([lang])
+
+    def play(self):
+        if not self.sentence:
+            return None
+        text = self.sentence_text()
+        self.speak_text(text, PRIORITY_EXPANSION)
+        self.usage.record('play', self.current_language, len(self.sentence), text)
+        self.learn_sentence()
+        self.remember_phrase(text)
+        return text
+
+    def expand(self):
+        if not self.sentence:
+            return None
+        # 通常后台已经算好并合成好了，直接使用；否则当场计算
+        candidates = self.speculator.result_for(self.sentence, self.current_language)
+        if candidates is None:
+            candidates = self.expander.expand(self.sentence, self.current_language)
+        self.learn_sentence()
+        self.speak_text(candidates[0], PRIORITY_EXPANSION)
+        self.usage.record('expand', self.current_language, len(self.sentence), candidates[0])
+        self.remember_phrase(candidates[0])
+        return candidates
+
+    def emergency(self):
+        # 紧急呼叫走单独的通道：马上响警报，其他朗读停掉，一直重复到 acknowledge_emergency()
+        msg = self.t('emergency_msg')
+        self.alarm.trigger(self.current_language)
+        self.usage.record('emergency', self.current_language)
+        self.notify('emergency')
+        return msg
+
+    def acknowledge_emergency(self):
+        seconds = self.alarm.acknowledge()
+        if seconds is not None:
+            self.usage.record('emergency_ack', round(seconds, 1))
+            self.notify('emergency')
+        return seconds
+
+    def _prepare_alarm(self):
+        self.alarm.prepare(self.current_language, self.t('emergency_msg'), self.current_voice_id)
+
+    def add_typed_text(self, text, item_id=None):
+        # 输入的正好是词库里的词时直接用该词条，否则创建一个临时的词汇对象
+        entry = self.vocab.by_id(item_id) if item_id is not None else self.vocab.find_text(text, self.current_language)
+        if entry is not None:
+            self.add(entry)
+            return
+        count = self.predictor.note_manual(text)
+        self.completion_trie(self.current_language).insert(text, None, weight=count + 1)
+        self.add({'manual_text': text, 'category': 'manual'})
+
+    def _vocabulary_stamp(self):
+        # 词库文件和各语言包的修改时间
+        stamps = []
+        for path in [self.vocab_path] + [os.path.join(self.locales.directory, lang + ".json") for lang in self.locales.languages]:
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def reload_vocabulary(self, force=False):
+        # 词库或语言包被编辑过时重新加载（读失败时保留原来的，下次再试）；句子里已有的词块不变
+        stamp = self._vocabulary_stamp()
+        if not force and stamp == self._vocab_stamp:
+            return False
+        try:
+            vocab = VocabularyStore(self.vocab_path, LocaleStore(self.locales.directory))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Vocabulary reload error: {e}")
+            return False
+        self._vocab_stamp = stamp
+        self.locales = vocab.locales
+        self.vocab = vocab
+        self.categories_data = vocab.categories
+        self._completion_tries = {}
+        if self.categories_data and self.current_category not in {cat['id'] for cat in self.categories_data}:
+            self.current_category = self.categories_data[0]['id']
+        self.notify('vocabulary')
+        return True
+
+    def _speculate(self):
+        self.speculator.submit(self.sentence, self.current_language, self.current_voice_id, self.rate)
+
+    # --- 预测 ---
+    def predictions(self):
+        items = []
+        for token in self.predictor.predict(sentence_tokens(self.sentence)):
+            if token.startswith("v:"):
+                item = self.vocab.by_id(int(token[2:]))
+                if item is not None:
+                    items.append(item)
+            else:
+                items.append({'manual_text': token[2:], 'category': 'manual'})
+        return items
+
+    def completion_trie(self, lang):
+        trie = self._completion_tries.get(lang)
+        if trie is None:
+            trie = PrefixTrie()
+            for entry in self.vocab:
+                trie.insert(entry[lang], entry.id, weight=self.predictor.count("v:%d" % entry.id) + 1)
+            for text, count in self.predictor.manual.items():
+                trie.insert(text, None, weight=count + 1)
+            self._completion_tries[lang] = trie
+        return trie
+
+    def learn_sentence(self):
+        # 句子没改过时播放和扩展只学习一次；改过（哪怕又拼回同一句）再说就再学一次
+        if self.sentence == self._learned_sentence:
+            return
+        self._learned_sentence = list(self.sentence)
+        tokens = sentence_tokens(self.sentence)
+        self.predictor.learn(tokens)
+        # 已经建好的补全前缀树里，这些词的权重跟着新的次数更新
+        for token in set(tokens):
+            entry = self.vocab.by_id(int(token[2:])) if token.startswith("v:") else None
+            if entry is None:
+                continue
+            weight = self.predictor.count(token) + 1
+            for lang, trie in self._completion_tries.items():
+                trie.insert(entry[lang], entry.id, weight=weight)
+        if self.predictor.dirty >= 10:
+            self.predictor.save()
+
+    # --- 常用句 ---
+    def remember_phrase(self, text, lang=None):
+        # 存下的句子空闲时用它所属语言的语音合成进音频缓存，以后调出来直接播放
+        lang = lang or self.current_language
+        self.phrases.add(text, lang)
+        self.speech.prefetch(text, self.voice_for_language(lang), self.rate)
+        if self.phrases.dirty >= 10:
+            self.phrases.save()
+
+    def search_phrases(self, query, k=PHRASE_RESULTS):
+        return self.phrases.search(query, k, self.current_language)
+
+    def recall_phrase(self, text, lang):
+        # 用这句话所属语言的语音说出来（存句子时已经合成进音频缓存）
+        self.speech.speak(text, PRIORITY_EXPANSION, voice_id=self.voice_for_language(lang), rate=self.rate)
+        self.usage.record('phrase', lang, text)
+        self.remember_phrase(text, lang)
+
+    # --- 语音 ---
+    def speak_text(self, text, priority=PRIORITY_WORD, trace=None):
+        self.speech.speak(text, priority, voice_id=self.current_voice_id, rate=self.rate, trace=trace)
+
+    def export_metrics(self, path=None):
+        return self.metrics.export(path or self.metrics_file)
+
+    def voice_for_language(self, lang):
+        return self.language_voices.get(lang) or self.current_voice_id
+
+    def _on_voices_discovered(self, voices):
+        voices = describe_voices(voices)
+        ids = {v['id'] for v in voices}
+        # 已有的选择（缓存或设置里选的）只要语音还在就保留
+        mapping = pick_language_voices(voices, self.locales.languages)
+        for lang, voice_id in self.language_voices.items():
+            if voice_id in ids:
+                mapping[lang] = voice_id
+        key = voice_inventory_key(self.tts_driver, voices)
+        changed = mapping != self.language_voices or self.voice_inventory_key is None
+        self.voice_list = voices
+        self.language_voices = mapping
+        self.voices_ready = True
+        if changed or key != self.voice_inventory_key:
+            self.voice_inventory_key = key
+            save_voice_cache(self.tts_driver, voices, mapping, self.voice_cache_file)
+        if self.current_voice_id not in ids or mapping.get(self.current_language):
+            self.current_voice_id = mapping.get(self.current_language) or (voices[0]['id'] if voices else None)
+        if changed:
+            self.prefill_audio_cache()
+        self._prepare_alarm()
+        self.notify('voices')
+
+    def apply_voice_settings(self, voice_id, rate):
+        old_voice_id, old_rate = self.current_voice_id, self.rate
+        self.rate = rate
+        self.current_voice_id = voice_id
+        # 记住当前语言所选的语音
+        if self.current_voice_id:
+            self.language_voices[self.current_language] = self.current_voice_id
+            if self.voices_ready:
+                save_voice_cache(self.tts_driver, self.voice_list, self.language_voices, self.voice_cache_file)
+        if old_rate != self.rate:
+            self.audio_cache.invalidate(rate=old_rate)
+        elif old_voice_id != self.current_voice_id:
+            self.audio_cache.invalidate(voice_id=old_voice_id)
+        if old_voice_id != self.current_voice_id:
+            self._prepare_alarm()
+        if (old_voice_id, old_rate) != (self.current_voice_id, self.rate):
+            self.prefill_audio_cache()
+
+    def prefill_audio_cache(self, langs=None):
+        # 后台预合成所有词汇和常用扩展句，当前语言优先。列出任务要遍历整个词库并逐个扩展，
+        # 词库大时要几百毫秒，所以放在单独的线程里，不占用启动、切换语言和换语音的界面线程
+        langs = self._audio_langs(langs)
+        threading.Thread(target=self._prefill, args=(langs,), name="AudioPrefill", daemon=True).start()
+
+    def _prefill(self, langs):
+        try:
+            for text, voice_id, rate in self.audio_jobs(langs):
+                self.speech.prefetch(text, voice_id, rate)
+        except Exception as e:
+            print(f"Audio prefill error: {e}")
+
+    def _audio_langs(self, langs):
+        if langs is None:
+            langs = [self.current_language] + [l for l in self.locales.loaded() if l != self.current_language]
+        return list(langs)
+
+    def audio_jobs(self, langs=None):
+        # 值得提前合成的 (文本, 语音ID, 语速)：先是所有词汇，再是固定扩展句、每个词的常用扩展句和紧急呼叫。
+        # 默认只包括当前语言和已经用过的语言
+        langs = self._audio_langs(langs)
+        for lang in langs:
+            voice_id = self.voice_for_language(lang)
+            for item in self.vocab:
+                yield item[lang], voice_id, self.rate
+        for lang in langs:
+            voice_id = self.voice_for_language(lang)
+            phrases = self.expander.fixed_phrases(lang)
+            for item in self.vocab:
+                phrases.extend(self.expander.expand([item], lang)[:3])
+            for text in phrases:
+                yield text, voice_id, self.rate
+            yield self.strings(lang)['emergency_msg'], voice_id, EMERGENCY_RATE
+
+
+# --- 界面 ---
+PERF_OVERLAY_INTERVAL_MS = 500
+VOCAB_WATCH_MS = 2000      # 检查词库文件是否被编辑过的间隔
+DISPATCH_INTERVAL_MS = 15  # 主循环取后台结果的间隔，约一帧
+DISPATCH_BATCH = 64
+
+
+class AACApp(tk.Tk):
+    # Tk 界面只负责显示 AACCore 的状态并把点击转给它
+    def __init__(self, core=None, engine_factory=None, data_dir=APP_DATA_DIR):
+        super().__init__()
+
+        self.title("Selftronic AAC V1R3 (Python Desktop)")
+        self.geometry("1100x750")
+        self.configure(bg="#f0f2f5")
+
+        if core is None:
+            player = AudioPlayer() if engine_factory is None else None
+            core = AACCore(engine_factory=engine_factory, player=player, data_dir=data_dir)
+        self.core = core
+        # 后台线程不直接碰 Tk：结果放进线程安全的队列，由主循环定时取出执行
+        self._dispatch = queue.SimpleQueue()
+        self.core.post = self._dispatch.put
+        # 模型变化只记下受影响的区域，同一帧里的多次变化合并成一次 after_idle 重绘
+        self._dirty = set()
+        self._redraw_pending = None
+        self.core.listeners.append(self._on_core_change)
+        self._settings_voice_ui = None
+        self.glyphs = GlyphCache(os.path.join(self.core.data_dir, "glyphs"))
+        self.perf_overlay = None
+        self._perf_after = None
+        self.show_dialogs = True  # 回放压力测试时关掉会阻塞主循环的模态对话框
+        self.emergency_banner = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.setup_ui()
-        self.update_ui_text() 
+        self.update_ui_text()
+        # F12 显示/隐藏性能浮层，F5 重新加载词库
+        self.bind("<F12>", lambda e: self.toggle_perf_overlay())
+        self.bind("<F5>", lambda e: self.core.reload_vocabulary(force=True))
+        self._dispatch_after = self.after(DISPATCH_INTERVAL_MS, self._drain_dispatch)
+        self._vocab_after = self.after(VOCAB_WATCH_MS, self._watch_vocabulary)
+        self.core.start()
+
+    def _drain_dispatch(self):
+        # 每次最多执行 DISPATCH_BATCH 个，避免后台一下子送来很多结果时卡住主循环
+        for _ in range(DISPATCH_BATCH):
+            try:
+                fn = self._dispatch.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                fn()
+            except Exception as e:
+                print(f"UI dispatch error: {e}")
+        self._dispatch_after = self.after(DISPATCH_INTERVAL_MS, self._drain_dispatch)
+
+    def _watch_vocabulary(self):
+        self.core.reload_vocabulary()
+        self._vocab_after = self.after(VOCAB_WATCH_MS, self._watch_vocabulary)
+
+    def _on_core_change(self, region):
+        self._dirty.add(region)
+        if self._redraw_pending is None:
+            self._redraw_pending = self.after_idle(self._flush_redraw)
+
+    def _flush_redraw(self):
+        self._redraw_pending = None
+        dirty, self._dirty = self._dirty, set()
+        if 'vocabulary' in dirty:
+            # 重新加载词库时整个界面都会重画
+            dirty -= {'language', 'category', 'sentence'}
+        if 'language' in dirty:
+            # 换语言时整个界面的文字都要更新，已经包括分类栏、词卡和句子条
+            dirty -= {'category', 'sentence'}
+        for region in ('vocabulary', 'language', 'category', 'sentence', 'voices', 'emergency'):
+            if region in dirty:
+                t0 = time.perf_counter()
+                self._redraw(region)
+                self.core.metrics.observe(f"redraw_{region}", (time.perf_counter() - t0) * 1000)
+        self.core.metrics.count('redraw_flushes')
+
+    def _redraw(self, region):
+        if region == 'sentence':
+            self.update_sentence_display()
+        elif region == 'category':
+            self.highlight_category()
+            self.render_grid()
+        elif region == 'language':
+            self.update_ui_text()
+        elif region == 'voices':
+            if self._settings_voice_ui and self._settings_voice_ui[0].winfo_exists():
+                self._populate_voice_list(*self._settings_voice_ui)
+        elif region == 'emergency':
+            self.update_emergency_banner()
+        elif region == 'vocabulary':
+            self.reload_boards()
 
     def setup_ui(self):
         style = ttk.Style()
@@ -186,7 +2557,7 @@ class AACApp(tk.Tk):
         self.emergency_btn = tk.Button(btn_frame, text="🔔", command=self.trigger_emergency, bg="#fee2e2", fg="red", relief="flat", font=("Arial", 12, "bold"))
         self.emergency_btn.pack(side="left", padx=5)
 
-        self.lang_btn = tk.Button(btn_frame, text="🌐 EN/CN", command=self.toggle_language, bg="#e2e8f0", relief="flat", font=("Arial", 10))
+        self.lang_btn = tk.Button(btn_frame, text="🌐", command=self.toggle_language, bg="#e2e8f0", relief="flat", font=("Arial", 10))
         self.lang_btn.pack(side="left", padx=5)
 
         self.settings_btn = tk.Button(btn_frame, text="", command=self.open_settings, bg="#f1f5f9", relief="flat")
@@ -198,7 +2569,19 @@ class AACApp(tk.Tk):
 
         self.sentence_container = tk.Frame(strip_frame, bg="#f8fafc", highlightbackground="#e2e8f0", highlightthickness=2)
         self.sentence_container.pack(fill="x", ipady=10, padx=5)
-        self.sentence_label = tk.Label(self.sentence_container, text="", bg="#f8fafc", fg="#94a3b8", font=("Arial", 12, "italic"))
+
+        # 句子条高度固定，内容过长时横向滚动；词块只做增量增删
+        self.strip_canvas = tk.Canvas(self.sentence_container, bg="#f8fafc", height=40, highlightthickness=0)
+        self.strip_canvas.pack(side="top", fill="x")
+        self.strip_scrollbar = ttk.Scrollbar(self.sentence_container, orient="horizontal", command=self.strip_canvas.xview)
+        self.strip_canvas.configure(xscrollcommand=self._on_strip_xscroll)
+        self.chip_frame = tk.Frame(self.strip_canvas, bg="#f8fafc")
+        self.strip_canvas.create_window((0, 20), window=self.chip_frame, anchor="w")
+        self.chip_frame.bind("<Configure>", self._on_chips_configure)
+        self.chips = []
+        self._strip_scroll_end = False
+
+        self.sentence_label = tk.Label(self.chip_frame, text="", bg="#f8fafc", fg="#94a3b8", font=("Arial", 12, "italic"))
         self.sentence_label.pack(side="left", padx=10)
 
         # Controls
@@ -221,6 +2604,16 @@ class AACApp(tk.Tk):
                   command=self.clear_sentence, width=10, pady=5, relief="flat")
         self.btn_clear.pack(side="left", padx=5)
 
+        # 预测栏：按钮只建一次，每次句子变化时改文字
+        self.prediction_frame = tk.Frame(strip_frame, bg="white")
+        self.prediction_frame.pack(fill="x")
+        self.prediction_buttons = []
+        for _ in range(PREDICTION_COUNT):
+            btn = tk.Button(self.prediction_frame, text="", bg="#ecfdf5", fg="#065f46", font=("Arial", 12), relief="flat", pady=3)
+            btn.item = None
+            btn.config(command=lambda b=btn: b.item and self.add_to_sentence(b.item))
+            self.prediction_buttons.append(btn)
+
         # --- Main Content ---
         content_frame = tk.Frame(self, bg="#f0f2f5")
         content_frame.pack(side="top", fill="both", expand=True, pady=15)
@@ -236,21 +2629,51 @@ class AACApp(tk.Tk):
         # Keyboard Input Button (New V1R3) - Bottom of sidebar
         self.btn_keyboard = tk.Button(sidebar_container, text="⌨️", command=self.open_keyboard, bg="#f3f4f6", relief="flat", pady=10)
         self.btn_keyboard.pack(side="bottom", fill="x", padx=5, pady=10)
+        self.btn_phrases = tk.Button(sidebar_container, text="⭐", command=self.open_phrases, bg="#fef9c3", relief="flat", pady=10)
+        self.btn_phrases.pack(side="bottom", fill="x", padx=5)
         
+        self.category_buttons = {}
+        self._build_category_buttons()
+
         self.grid_canvas = tk.Canvas(content_frame, bg="#f0f2f5", highlightthickness=0)
-        self.grid_frame = tk.Frame(self.grid_canvas, bg="#f0f2f5")
         
-        scrollbar = ttk.Scrollbar(content_frame, orient="vertical", command=self.grid_canvas.yview)
-        self.grid_canvas.configure(yscrollcommand=scrollbar.set)
+        self.grid_scrollbar = ttk.Scrollbar(content_frame, orient="vertical", command=self.grid_canvas.yview)
+        self.grid_canvas.configure(yscrollcommand=self._on_grid_yscroll)
         
-        scrollbar.pack(side="right", fill="y", pady=(0, 15), padx=(0, 15))
+        self.grid_scrollbar.pack(side="right", fill="y", pady=(0, 15), padx=(0, 15))
         self.grid_canvas.pack(side="left", fill="both", expand=True, padx=10, pady=(0, 15))
-        
-        self.grid_canvas.create_window((0, 0), window=self.grid_frame, anchor="nw")
-        self.grid_frame.bind("<Configure>", lambda e: self.grid_canvas.configure(scrollregion=self.grid_canvas.bbox("all")))
+
+        # 大词汇量分类使用的虚拟网格
+        self.virtual_grid = VirtualGrid(self.grid_canvas, self.add_to_sentence, lambda item: item[self.core.current_language],
+                                        image_for=lambda item: self.glyphs.image(item['emoji'], GLYPH_CARD_SIZE, item['image']))
+
+        # 每个分类的词卡面板只建一次，作为画布上的独立窗口，切换时只显示/隐藏
+        self.boards = {}
+        self.active_board = None
+
+    def _build_category_buttons(self):
+        for btn in self.category_buttons.values():
+            btn.destroy()
+        self.category_buttons = {}
+        for cat in self.core.categories_data:
+            btn = tk.Button(self.cat_frame, text=cat['icon'], font=("Arial", 11), bg="white", relief="flat", pady=15,
+                            command=lambda c=cat['id']: self.change_category(c))
+            btn.pack(fill="x", padx=5, pady=2)
+            self.category_buttons[cat['id']] = btn
+
+    def reload_boards(self):
+        # 词库重新加载后：分类栏按新的分类重建，已缓存的面板就地重新填充（复用卡片控件），删掉的分类丢掉面板
+        self._build_category_buttons()
+        categories = {cat['id'] for cat in self.core.categories_data}
+        for cat_id in list(self.boards):
+            if cat_id in categories:
+                self.refresh_board(cat_id)
+            else:
+                self._drop_board(cat_id)
+        self.update_ui_text()
 
     def update_ui_text(self):
-        t = self.translations[self.current_language]
+        t = self.core.strings()
         
         self.title_label.config(text=t['title'])
         self.settings_btn.config(text=t['settings'])
@@ -258,281 +2681,420 @@ class AACApp(tk.Tk):
         self.btn_ai.config(text=t['ai_btn'])
         self.btn_del.config(text=t['delete'])
         self.btn_clear.config(text=t['clear'])
-        self.btn_keyboard.config(text=t['keyboard'])
-        self.emergency_btn.config(text=t['emergency'])
-        
-        if not self.sentence:
-            self.sentence_label.config(text=t['placeholder'])
-
-        for widget in self.cat_frame.winfo_children():
-            widget.destroy()
+        self.btn_keyboard.config(text=t['keyboard'])
+        self.btn_phrases.config(text=t['phrases'])
+        self.emergency_btn.config(text=t['emergency'])
+        self.lang_btn.config(text=f"🌐 {t['language']}")
         
-        for cat in self.categories_data:
-            label_text = cat[f'label_{self.current_language}']
-            bg_color = "#e0e7ff" if self.current_category == cat['id'] else "white"
-            
-            btn = tk.Button(self.cat_frame, text=f"{cat['icon']}\n{label_text}", 
-                            font=("Arial", 11), bg=bg_color, relief="flat", pady=15,
-                            command=lambda c=cat['id']: self.change_category(c))
-            btn.pack(fill="x", padx=5, pady=2)
+        for cat in self.core.categories_data:
+            label_text = self.core.vocab.label(cat, self.core.current_language)
+            self.category_buttons[cat['id']].config(text=f"{cat['icon']}\n{label_text}")
+        self.highlight_category()
 
         self.render_grid()
         self.update_sentence_display()
-
-        if self.current_language == 'zh':
-            if self.zh_voice_id: self.current_voice_id = self.zh_voice_id
-        else:
-            if self.en_voice_id: self.current_voice_id = self.en_voice_id
+        if self.emergency_banner is not None:
+            self.update_emergency_banner()
 
     def toggle_language(self):
-        self.current_language = 'zh' if self.current_language == 'en' else 'en'
-        self.sentence = [] 
-        self.update_ui_text()
+        self.core.toggle_language()
 
     def render_grid(self):
-        for widget in self.grid_frame.winfo_children():
-            widget.destroy()
+        board = self.boards.get(self.core.current_category)
+        if board is None:
+            board = self._build_board(self.core.current_category)
+        elif board['lang'] != self.core.current_language:
+            self._relabel_board(board)
 
-        items = [v for v in self.vocabulary_db if v['category'] == self.current_category]
-        
+        if self.active_board is not board:
+            if self.active_board is not None:
+                self._hide_board(self.active_board)
+            self.active_board = board
+            self._show_board(board)
+            self.grid_canvas.yview_moveto(0)
+        self._update_scrollregion(board)
+
+    def _build_board(self, cat_id):
+        items = self.core.vocab.by_category(cat_id)
+        if len(items) > VIRTUAL_GRID_THRESHOLD:
+            board = {'id': cat_id, 'virtual': True, 'items': items, 'lang': self.core.current_language}
+            self.boards[cat_id] = board
+            return board
+        frame = tk.Frame(self.grid_canvas, bg="#f0f2f5")
+        window = self.grid_canvas.create_window((0, 0), window=frame, anchor="nw", state='hidden')
+        board = {'id': cat_id, 'virtual': False, 'frame': frame, 'window': window, 'cards': [], 'spare': [], 'lang': None}
+        frame.bind("<Configure>", lambda e, b=board: self._update_scrollregion(b))
+        self.boards[cat_id] = board
+        self._fill_board(board, items)
+        return board
+
+    def _show_board(self, board):
+        if board['virtual']:
+            self.virtual_grid.show(board['items'])
+        else:
+            self.grid_canvas.itemconfigure(board['window'], state='normal')
+
+    def _hide_board(self, board):
+        if board['virtual']:
+            self.virtual_grid.hide()
+        else:
+            self.grid_canvas.itemconfigure(board['window'], state='hidden')
+
+    def refresh_board(self, cat_id):
+        # 分类内容变化时重新填充已缓存的面板（复用卡片控件）
+        board = self.boards.get(cat_id)
+        if board is None:
+            return
+        items = self.core.vocab.by_category(cat_id)
+        if board['virtual'] != (len(items) > VIRTUAL_GRID_THRESHOLD):
+            # 规模跨过阈值时换一种面板
+            self._drop_board(cat_id)
+            if cat_id == self.core.current_category:
+                self.render_grid()
+        elif board['virtual']:
+            board['items'] = items
+            if board is self.active_board:
+                self.virtual_grid.show(items)
+                self._update_scrollregion(board)
+        else:
+            self._fill_board(board, items)
+
+    def _drop_board(self, cat_id):
+        board = self.boards.pop(cat_id)
+        if board is self.active_board:
+            self._hide_board(board)
+            self.active_board = None
+        if not board['virtual']:
+            board['frame'].destroy()
+            self.grid_canvas.delete(board['window'])
+
+    def _fill_board(self, board, items):
+        pool = iter(board['cards'] + board['spare'])
+        board['cards'], board['spare'] = [], []
         columns = 4
         for i, item in enumerate(items):
-            row = i // columns
-            col = i % columns
-            
-            display_text = item[self.current_language]
-            
-            card = tk.Frame(self.grid_frame, bg="white", bd=1, relief="solid")
-            card.grid(row=row, column=col, padx=8, pady=8, ipadx=10, ipady=10, sticky="nsew")
-            
-            lbl_emoji = tk.Label(card, text=item['emoji'], font=("Segoe UI Emoji", 32), bg="white")
-            lbl_emoji.pack()
-            
-            lbl_text = tk.Label(card, text=display_text, font=("Arial", 12, "bold"), bg="white", fg="#1e293b")
-            lbl_text.pack()
-            
-            for w in [card, lbl_emoji, lbl_text]:
-                w.bind("<Button-1>", lambda e, it=item: self.add_to_sentence(it))
+            card = next(pool, None) or self._create_card(board['frame'])
+            card['item'] = item
+            self._set_symbol(card['emoji'], item['emoji'], GLYPH_CARD_SIZE, item['image'])
+            card['text'].config(text=item[self.core.current_language])
+            card['frame'].grid(row=i // columns, column=i % columns, padx=8, pady=8, ipadx=10, ipady=10, sticky="nsew")
+            board['cards'].append(card)
+        for card in pool:
+            card['frame'].grid_remove()
+            board['spare'].append(card)
+        board['lang'] = self.core.current_language
+
+    def _create_card(self, parent):
+        card = {'item': None}
+        card['frame'] = tk.Frame(parent, bg="white", bd=1, relief="solid")
+        card['emoji'] = tk.Label(card['frame'], font=("Segoe UI Emoji", 32), bg="white")
+        card['emoji'].pack()
+        card['text'] = tk.Label(card['frame'], font=("Arial", 12, "bold"), bg="white", fg="#1e293b")
+        card['text'].pack()
+        # 只在创建时绑定一次，点击时读取卡片当前对应的词汇
+        for w in [card['frame'], card['emoji'], card['text']]:
+            w.bind("<Button-1>", lambda e, c=card: self.add_to_sentence(c['item']))
+        return card
+
+    def _set_symbol(self, label, symbol, size, picture=None):
+        # 有缓存图片时显示图片，否则按原样用表情字体显示文字
+        image = self.glyphs.image(symbol, size, picture)
+        label.image = image
+        label.config(image=image if image is not None else "", text="" if image is not None else symbol)
+
+    def _relabel_board(self, board):
+        board['lang'] = self.core.current_language
+        if board['virtual']:
+            if board is self.active_board:
+                self.virtual_grid.redraw()
+            return
+        for card in board['cards']:
+            card['text'].config(text=card['item'][self.core.current_language])
+
+    def _update_scrollregion(self, board):
+        if board is not self.active_board:
+            return
+        if board['virtual']:
+            self.grid_canvas.configure(scrollregion=self.virtual_grid.scrollregion())
+        else:
+            frame = board['frame']
+            self.grid_canvas.configure(scrollregion=(0, 0, frame.winfo_reqwidth(), frame.winfo_reqheight()))
+
+    def _on_grid_yscroll(self, first, last):
+        # 视图每次变化（滚动、缩放窗口）都会回调这里，顺便刷新虚拟网格的可见区域
+        self.grid_scrollbar.set(first, last)
+        self.virtual_grid.refresh()
+
+    def highlight_category(self):
+        for cat_id, btn in self.category_buttons.items():
+            btn.config(bg="#e0e7ff" if self.core.current_category == cat_id else "white")
 
     def change_category(self, cat_id):
-        self.current_category = cat_id
-        self.update_ui_text()
+        self.core.set_category(cat_id)
 
     def update_sentence_display(self):
-        for widget in self.sentence_container.winfo_children():
-            widget.destroy()
-            
-        t = self.translations[self.current_language]
+        # 只处理变化的部分：保留与句子前缀一致的词块，删掉多余的，补上新增的
+        keep = 0
+        for chip, item in zip(self.chips, self.core.sentence):
+            if chip['item'] is not item:
+                break
+            keep += 1
+        for chip in self.chips[keep:]:
+            chip['frame'].destroy()
+        del self.chips[keep:]
 
-        if not self.sentence:
-            self.sentence_label = tk.Label(self.sentence_container, text=t['placeholder'], bg="#f8fafc", fg="#94a3b8", font=("Arial", 12, "italic"))
-            self.sentence_label.pack(side="left", padx=10)
-            return
+        for chip in self.chips:
+            if chip['lang'] != self.core.current_language:
+                self._label_chip(chip)
+        for item in self.core.sentence[keep:]:
+            self.chips.append(self._create_chip(item))
+            self._strip_scroll_end = True
 
-        for item in self.sentence:
-            # item 可能是普通词汇字典，也可能是手动输入的文本对象
-            if 'manual_text' in item:
-                txt = item['manual_text']
-                emoji = "⌨️"
-            else:
-                txt = item[self.current_language]
-                emoji = item['emoji']
-                
-            chip = tk.Frame(self.sentence_container, bg="white", bd=1, relief="solid")
-            chip.pack(side="left", padx=5, pady=2)
-            tk.Label(chip, text=f"{emoji} {txt}", font=("Arial", 12), bg="white", padx=5, pady=2).pack()
+        if self.core.sentence:
+            self.sentence_label.pack_forget()
+        else:
+            t = self.core.strings()
+            self.sentence_label.config(text=t['placeholder'])
+            if not self.sentence_label.winfo_manager():
+                self.sentence_label.pack(side="left", padx=10)
+        self.update_predictions()
 
-    def add_to_sentence(self, item):
-        self.sentence.append(item)
-        self.update_sentence_display()
-        # 发音
+    def update_predictions(self):
+        items = self.core.predictions()
+        for i, btn in enumerate(self.prediction_buttons):
+            if i < len(items):
+                item = items[i]
+                label = f"⌨️ {item['manual_text']}" if 'manual_text' in item else f"{item['emoji']} {item[self.core.current_language]}"
+                btn.item = item
+                btn.config(text=label)
+                if not btn.winfo_manager():
+                    btn.pack(side="left", padx=5, pady=(0, 5))
+            elif btn.winfo_manager():
+                btn.item = None
+                btn.pack_forget()
+
+    def _create_chip(self, item):
+        chip = {'item': item, 'lang': None}
+        chip['frame'] = tk.Frame(self.chip_frame, bg="white", bd=1, relief="solid")
+        chip['frame'].pack(side="left", padx=5, pady=2)
+        chip['label'] = tk.Label(chip['frame'], font=("Arial", 12), bg="white", padx=5, pady=2)
+        chip['label'].pack()
+        self._label_chip(chip)
+        return chip
+
+    def _label_chip(self, chip):
+        item = chip['item']
+        # item 可能是普通词汇，也可能是手动输入的文本对象
         if 'manual_text' in item:
-            self.speak_text(item['manual_text'])
+            txt = item['manual_text']
+            emoji, picture = "⌨️", None
+        else:
+            txt = item[self.core.current_language]
+            emoji, picture = item['emoji'], item['image']
+        if len(txt) > MAX_CHIP_CHARS:
+            txt = txt[:MAX_CHIP_CHARS - 1] + "…"
+        image = self.glyphs.image(emoji, GLYPH_CHIP_SIZE, picture)
+        chip['label'].image = image
+        if image is not None:
+            chip['label'].config(image=image, compound="left", text=f" {txt}")
         else:
-            self.speak_text(item[self.current_language])
+            chip['label'].config(text=f"{emoji} {txt}")
+        chip['lang'] = self.core.current_language
+
+    def _on_chips_configure(self, event):
+        self.strip_canvas.configure(scrollregion=(0, 0, event.width, 40))
+        if self._strip_scroll_end:
+            self._strip_scroll_end = False
+            self.strip_canvas.xview_moveto(1.0)
+
+    def _on_strip_xscroll(self, first, last):
+        # 内容超出宽度时才显示横向滚动条
+        self.strip_scrollbar.set(first, last)
+        if float(first) > 0 or float(last) < 1:
+            if not self.strip_scrollbar.winfo_manager():
+                self.strip_scrollbar.pack(side="top", fill="x")
+        elif self.strip_scrollbar.winfo_manager():
+            self.strip_scrollbar.pack_forget()
+
+    def add_to_sentence(self, item):
+        self.core.add(item)
 
     def open_keyboard(self):
-        t = self.translations[self.current_language]
-        text = simpledialog.askstring(t['input_title'], t['input_msg'], parent=self)
-        if text:
-            # 创建一个临时的词汇对象
-            manual_item = {'manual_text': text, 'category': 'manual'}
-            self.add_to_sentence(manual_item)
+        # 输入框下方随输入显示补全（词库词和以前手动输入过的话），点一下即可选中
+        t = self.core.strings()
+        trie = self.core.completion_trie(self.core.current_language)
+        win = tk.Toplevel(self)
+        win.title(t['input_title'])
+        win.transient(self)
+        tk.Label(win, text=t['input_msg'], font=("Arial", 11)).pack(anchor="w", padx=15, pady=(15, 5))
+        var = tk.StringVar()
+        entry = tk.Entry(win, textvariable=var, font=("Arial", 14), width=32)
+        entry.pack(fill="x", padx=15)
+        listbox = tk.Listbox(win, font=("Arial", 12), height=PREDICTION_COUNT, activestyle="none")
+        listbox.pack(fill="both", expand=True, padx=15, pady=10)
+        matches = []
+
+        def refresh(*args):
+            prefix = var.get().strip()
+            matches[:] = trie.complete(prefix) if prefix else []
+            listbox.delete(0, "end")
+            for text, payload in matches:
+                listbox.insert("end", text)
+
+        def submit(text, item_id=None):
+            win.destroy()
+            self.core.add_typed_text(text, item_id)
+
+        def accept(event=None):
+            if var.get().strip():
+                submit(var.get().strip())
+
+        def choose(event=None):
+            sel = listbox.curselection()
+            if sel:
+                text, payload = matches[sel[0]]
+                submit(text, payload)
+
+        var.trace_add("write", refresh)
+        entry.bind("<Return>", accept)
+        listbox.bind("<<ListboxSelect>>", choose)
+        tk.Button(win, text=t['ok'], command=accept, bg="#2563eb", fg="white", width=10).pack(pady=(0, 15))
+        entry.focus_set()
+
+    def open_phrases(self):
+        # 常用句搜索：每输入一个字就重新搜索，点一下直接说出来
+        t = self.core.strings()
+        win = tk.Toplevel(self)
+        win.title(t['phrases_title'])
+        win.transient(self)
+        var = tk.StringVar()
+        entry = tk.Entry(win, textvariable=var, font=("Arial", 14), width=40)
+        entry.pack(fill="x", padx=15, pady=(15, 5))
+        listbox = tk.Listbox(win, font=("Arial", 12), height=PHRASE_RESULTS, activestyle="none")
+        listbox.pack(fill="both", expand=True, padx=15, pady=(5, 15))
+        results = []
+
+        def refresh(*args):
+            results[:] = self.core.search_phrases(var.get())
+            listbox.delete(0, "end")
+            for text, lang, count in results:
+                listbox.insert("end", f"{text}    ×{count}")
+            if not results:
+                listbox.insert("end", t['phrases_empty'])
+
+        def choose(event=None):
+            sel = listbox.curselection()
+            if sel and sel[0] < len(results):
+                text, lang, count = results[sel[0]]
+                win.destroy()
+                self.core.recall_phrase(text, lang)
+
+        def accept(event=None):
+            if results:
+                listbox.selection_set(0)
+                choose()
+
+        var.trace_add("write", refresh)
+        entry.bind("<Return>", accept)
+        listbox.bind("<<ListboxSelect>>", choose)
+        refresh()
+        entry.focus_set()
 
     def trigger_emergency(self):
-        t = self.translations[self.current_language]
-        msg = t['emergency_msg']
-        messagebox.showwarning(t['emergency'], msg)
-        # 紧急呼叫，大声且快速
-        def _alarm():
-            try:
-                with self.engine_init_lock:
-                    engine = pyttsx3.init()
-                    if self.current_voice_id:
-                        try: engine.setProperty('voice', self.current_voice_id)
-                        except: pass
-                    engine.setProperty('rate', 170) # 快一点
-                    engine.setProperty('volume', 1.0) # 最大音量
-                    engine.say(msg)
-                    engine.runAndWait()
-            except: pass
-        threading.Thread(target=_alarm).start()
+        # 警报在紧急通道里马上响起；界面只盖一条不阻塞的横幅，点确认才停
+        self.core.emergency()
+
+    def acknowledge_emergency(self):
+        self.core.acknowledge_emergency()
+
+    def update_emergency_banner(self):
+        if self.emergency_banner is not None:
+            self.emergency_banner.destroy()
+            self.emergency_banner = None
+        if not self.core.alarm.active:
+            return
+        t = self.core.strings()
+        banner = tk.Frame(self, bg="#dc2626", padx=30, pady=20)
+        tk.Label(banner, text=t['emergency_msg'], font=("Arial", 20, "bold"), bg="#dc2626", fg="white").pack(pady=(0, 15))
+        tk.Button(banner, text=t['emergency_ack'], command=self.acknowledge_emergency, font=("Arial", 14, "bold"),
+                  bg="white", fg="#dc2626", relief="flat", padx=20, pady=8).pack()
+        banner.place(relx=0.5, rely=0.5, anchor="center")
+        banner.lift()
+        self.emergency_banner = banner
 
     def backspace(self):
-        if self.sentence:
-            self.sentence.pop()
-            self.update_sentence_display()
+        self.core.backspace()
 
     def clear_sentence(self):
-        self.sentence = []
-        self.update_sentence_display()
+        self.core.clear()
 
     def play_sentence(self):
-        if not self.sentence: return
-        
-        words = []
-        for item in self.sentence:
-            if 'manual_text' in item:
-                words.append(item['manual_text'])
-            else:
-                words.append(item[self.current_language])
-                
-        full_text = " ".join(words)
-        self.speak_text(full_text)
+        self.core.play()
 
     def ai_expand(self):
-        if not self.sentence: return
-        t = self.translations[self.current_language]
-        self.btn_ai.config(text=t['ai_thinking'])
-        self.update() 
-        threading.Thread(target=self._ai_process).start()
-
-    def _ai_process(self):
-        time.sleep(0.6)
-        
-        words = []
-        last_category = 'other'
-        last_word_text = ""
-        
-        # 提取单词和最后一个分类
-        for item in self.sentence:
-            if 'manual_text' in item:
-                words.append(item['manual_text'])
-                last_category = 'manual'
-                last_word_text = item['manual_text']
-            else:
-                words.append(item[self.current_language])
-                last_category = item['category']
-                last_word_text = item[self.current_language].lower()
-
-        full_text = " ".join(words)
-        expanded_text = full_text 
+        candidates = self.core.expand()
+        if not candidates or not self.show_dialogs: return
+        t = self.core.strings()
+        msg = t['ai_result_msg'].format(candidates[0])
+        if len(candidates) > 1:
+            msg += "\n\n" + t['ai_more'] + "\n" + "\n".join(f"• {c}" for c in candidates[1:4])
+        messagebox.showinfo(t['ai_result_title'], msg)
 
-        if self.current_language == 'zh':
-            # --- 中文规则引擎 V3 ---
-            expanded_text = f"请问我可以{full_text}吗？"
-            
-            # 1. 紧急处理
-            if last_category == 'feeling' and last_word_text in ['痛', '害怕', '生气']:
-                 expanded_text = f"我感到{last_word_text}，我很不舒服。"
-            
-            # 2. 动作处理
-            elif last_category == 'action':
-                if last_word_text in ['睡觉', '洗澡', '画画']:
-                    expanded_text = f"我想去{last_word_text}。"
-                elif last_word_text == '停':
-                    expanded_text = "请停下来，我不喜欢这样。"
-                else:
-                    expanded_text = f"我想{last_word_text}。"
-            
-            # 3. 特定组合
-            elif '我' in words and '家' in words: expanded_text = "我想回家了。"
-            elif '不' in words and '吃' in words: expanded_text = "我不想吃这个。"
-            
-        else:
-            # --- English Smart Rules Engine (V3) ---
-            
-            # 1. Negation (Improved)
-            if 'no' in [w.lower() for w in words]:
-                content_words = [w for w in words if w.lower() != 'no']
-                if content_words:
-                    expanded_text = f"I don't want {content_words[-1].lower()}."
-                else:
-                    expanded_text = "No, thank you."
-            
-            # 2. Feelings (New V3 Words)
-            elif last_category == 'feeling':
-                if last_word_text in ['pain', 'scared', 'angry']:
-                    expanded_text = f"I am feeling {last_word_text}, please help."
-                elif last_word_text in ['bored', 'tired']:
-                    expanded_text = f"I am {last_word_text}, I want to do something else."
-                else:
-                    expanded_text = f"I feel {last_word_text}."
-                
-            # 3. Actions (Improved Grammar)
-            elif last_category == 'action':
-                # Distinguish between transitive and intransitive broadly
-                if last_word_text in ['sleep', 'run', 'swim', 'bath', 'draw', 'go']:
-                     expanded_text = f"I want to {last_word_text}."
-                elif last_word_text == 'stop':
-                    expanded_text = "Please stop that immediately."
-                elif last_word_text == 'help':
-                    expanded_text = "Please help me."
-                else:
-                    expanded_text = f"I want to {last_word_text}."
+    def on_close(self):
+        self.after_cancel(self._dispatch_after)
+        self.after_cancel(self._vocab_after)
+        self.core.close()
+        self.destroy()
 
-            # 4. People
-            elif last_category == 'people':
-                expanded_text = f"I want {last_word_text}."
-            
-            # 5. Default Requests
-            elif last_category in ['food', 'object']:
-                templates = [
-                    f"May I have {last_word_text}, please?",
-                    f"I would like {last_word_text}, please.",
-                    f"Can I get {last_word_text}?"
-                ]
-                expanded_text = random.choice(templates)
-
-        self.after(0, lambda: self._ai_done(expanded_text))
-
-    def _ai_done(self, text):
-        t = self.translations[self.current_language]
-        self.btn_ai.config(text=t['ai_btn'])
-        msg = t['ai_result_msg'].format(text)
-        messagebox.showinfo(t['ai_result_title'], msg)
-        self.speak_text(text)
+    # --- 性能浮层 ---
+    def toggle_perf_overlay(self):
+        if self.perf_overlay is not None:
+            self.after_cancel(self._perf_after)
+            self.perf_overlay.destroy()
+            self.perf_overlay = None
+            return
+        # 点击浮层把当前统计导出到数据目录
+        self.perf_overlay = tk.Label(self, font=("Courier", 9), justify="left", anchor="w",
+                                     bg="#0f172a", fg="#e2e8f0", padx=8, pady=6, cursor="hand2")
+        self.perf_overlay.place(relx=1.0, rely=1.0, x=-10, y=-10, anchor="se")
+        self.perf_overlay.bind("<Button-1>", lambda e: self._export_perf())
+        self._refresh_perf_overlay()
 
-    def speak_text(self, text):
-        def _speak():
-            try:
-                with self.engine_init_lock:
-                    engine = pyttsx3.init()
-                    if self.current_voice_id:
-                        try: engine.setProperty('voice', self.current_voice_id)
-                        except: pass
-                    engine.setProperty('rate', self.rate)
-                    engine.say(text)
-                    engine.runAndWait()
-            except Exception as e:
-                print(f"Speech error: {e}")
+    def _refresh_perf_overlay(self):
+        if self.perf_overlay is None:
+            return
+        metrics = self.core.metrics
+        lines = []
+        for name in ("tap->audio_start", "tap->enqueued", "enqueued->dequeued", "dequeued->engine_ready",
+                     "engine_ready->audio_start", "dequeued->audio_start", "speak_lock_wait", "redraw_sentence", "redraw_category"):
+            p = metrics.percentiles(name)
+            if p:
+                lines.append(f"{name:<26} p50 {p['p50']:>8.2f}  p95 {p['p95']:>8.2f}  p99 {p['p99']:>8.2f} ms")
+        depth = metrics.gauges.get('queue_depth', [0, 0])
+        lines.append(f"queue depth {depth[0]} (max {depth[1]})  "
+                     f"dropped {metrics.counters.get('stale_words_dropped', 0)}  "
+                     f"cache hits {metrics.counters.get('cache_hits', 0)}")
+        self.perf_overlay.config(text="\n".join(lines))
+        self._perf_after = self.after(PERF_OVERLAY_INTERVAL_MS, self._refresh_perf_overlay)
 
-        threading.Thread(target=_speak).start()
+    def _export_perf(self):
+        path = self.core.export_metrics(self.core.metrics_export)
+        print(f"Latency metrics written to {path}")
 
     def open_settings(self):
-        t = self.translations[self.current_language]
+        t = self.core.strings()
         win = tk.Toplevel(self)
         win.title(t['settings'])
         win.geometry("450x400")
         
         tk.Label(win, text=t['voice_speed'], font=("Arial", 10, "bold")).pack(pady=10)
         scale = tk.Scale(win, from_=50, to=300, orient="horizontal", length=200)
-        scale.set(self.rate)
+        scale.set(self.core.rate)
         scale.pack()
         
         tk.Label(win, text=t['voice_select'], font=("Arial", 10, "bold")).pack(pady=10)
         
-        voice_var = tk.StringVar(value=self.current_voice_id)
+        voice_var = tk.StringVar(value=self.core.current_voice_id)
         
         frame = tk.Frame(win)
         frame.pack(fill="both", expand=True, padx=20, pady=5)
@@ -545,24 +3107,1240 @@ class AACApp(tk.Tk):
         canvas.create_window((0, 0), window=scroll_content, anchor="nw")
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        for voice in self.voice_list:
-            v_name = voice.name
-            tag = ""
-            if "zh" in voice.languages or "Chinese" in v_name: tag = " [CN]"
-            elif "en" in voice.languages or "English" in v_name: tag = " [EN]"
-            
-            tk.Radiobutton(scroll_content, text=f"{v_name}{tag}", variable=voice_var, value=voice.id).pack(anchor="w")
+        self._settings_voice_ui = (scroll_content, voice_var)
+        self._populate_voice_list(scroll_content, voice_var)
 
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
         def save():
-            self.rate = scale.get()
-            self.current_voice_id = voice_var.get()
             win.destroy()
+            self.core.apply_voice_settings(voice_var.get(), scale.get())
             
         tk.Button(win, text=t['save'], command=save, bg="#2563eb", fg="white").pack(pady=10)
 
+    def _populate_voice_list(self, frame, voice_var):
+        for widget in frame.winfo_children():
+            widget.destroy()
+        if not self.core.voice_list:
+            # 后台语音枚举还没完成，完成后会自动填充
+            t = self.core.strings()
+            tk.Label(frame, text=t['voice_loading'], fg="#94a3b8").pack(anchor="w")
+            return
+        for voice in self.core.voice_list:
+            v_name = voice['name']
+            tag = ""
+            if "zh" in voice['languages'] or "Chinese" in v_name: tag = " [CN]"
+            elif "en" in voice['languages'] or "English" in v_name: tag = " [EN]"
+            
+            tk.Radiobutton(frame, text=f"{v_name}{tag}", variable=voice_var, value=voice['id']).pack(anchor="w")
+
+
+# --- 多客户端服务器 ---
+# 一台机器给整个教室的平板提供词库、扩展句和合成好的音频：
+# asyncio 处理 HTTP 和 WebSocket 连接，TTS 在进程池里合成（每个工作进程一个引擎），音频缓存所有会话共用
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_WORKERS = max(1, min(4, os.cpu_count() or 1))
+SERVER_MAX_PENDING = 64        # 排队合成超过这个数时新的音频请求直接返回 503，延迟不会无限增长
+SERVER_RENDER_TIMEOUT = 10.0   # 单个音频请求最多等待的秒数
+SERVER_MAX_BODY = 64 * 1024
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+HTTP_REASONS = {200: "OK", 101: "Switching Protocols", 400: "Bad Request", 404: "Not Found",
+                413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+# 合成工作进程里的引擎，由 _init_synthesis_worker 在进程启动时创建
+_worker_engine = None
+
+
+def _init_synthesis_worker(engine_factory):
+    global _worker_engine
+    _worker_engine = (engine_factory or create_tts_engine)()
+
+
+def _synthesize_clip(text, voice_id, rate, volume, path):
+    # 在工作进程里把文本合成到 path，成功返回 True
+    engine = _worker_engine
+    if voice_id:
+        engine.setProperty('voice', voice_id)
+    engine.setProperty('rate', rate)
+    engine.setProperty('volume', volume)
+    engine.save_to_file(text, path)
+    engine.runAndWait()
+    return os.path.exists(path) and os.path.getsize(path) > 44
+
+
+def _list_worker_voices():
+    return describe_voices(_worker_engine.getProperty('voices'))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=""):
+        super().__init__(message or HTTP_REASONS.get(status, ""))
+        self.status = status
+
+
+class ServerSession:
+    # 一个 WebSocket 客户端（一台平板）的句子和语言，词汇和扩展规则由服务器共享
+    def __init__(self, lang):
+        self.lang = lang
+        self.sentence = []
+
+
+class AACServer:
+    def __init__(self, engine_factory=None, data_dir=APP_DATA_DIR, vocab_path=VOCABULARY_FILE,
+                 rules_path=EXPANSION_RULES_FILE, host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS):
+        self.engine_factory = engine_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.vocab = VocabularyStore(vocab_path)
+        self.expander = ExpansionEngine(rules_path)
+        self.audio_cache = AudioCache(os.path.join(data_dir, "audio_cache"), prerendered=os.path.join(data_dir, PRERENDER_DIR_NAME))
+        self.metrics = LatencyTracker()
+        self.rate = 150
+        self.tts_driver = default_tts_driver()
+        self.voice_cache_file = os.path.join(data_dir, "voices.json")
+        voice_cache = load_voice_cache(self.tts_driver, self.voice_cache_file)
+        self.language_voices = dict(voice_cache['mapping']) if voice_cache else {}
+        self.sessions = set()
+        self.pool = None
+        self.server = None
+        self._renders = {}  # 缓存键 -> 正在合成的 Future，同一段文字只合成一次
+        self._board_json = {}
+
+    # --- 生命周期 ---
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_synthesis_worker,
+                                                           initargs=(self.engine_factory,))
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        loop.create_task(self._discover_voices())
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"AAC server listening on http://{self.host}:{self.port}")
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        self.audio_cache.close()
+
+    async def _discover_voices(self):
+        try:
+            voices = await asyncio.get_running_loop().run_in_executor(self.pool, _list_worker_voices)
+        except Exception as e:
+            print(f"Voice discovery error: {e}")
+            return
+        mapping = pick_language_voices(voices)
+        mapping.update({lang: v for lang, v in self.language_voices.items() if any(v == x['id'] for x in voices)})
+        self.language_voices = mapping
+        save_voice_cache(self.tts_driver, voices, mapping, self.voice_cache_file)
+
+    # --- 数据 ---
+    def board_json(self, lang):
+        # 词库不变，每种语言只序列化一次
+        body = self._board_json.get(lang)
+        if body is None:
+            board = {
+                'languages': list(self.vocab.languages),
+                'categories': [{'id': c['id'], 'label': self.vocab.label(c, lang), 'icon': c['icon'], 'color': c['color']}
+                               for c in self.vocab.categories],
+                'entries': {c['id']: [{'id': e.id, 'emoji': e.emoji, 'text': e[lang]} for e in self.vocab.by_category(c['id'])]
+                            for c in self.vocab.categories},
+            }
+            body = self._board_json[lang] = json.dumps(board, ensure_ascii=False).encode('utf-8')
+        return body
+
+    def resolve_items(self, values):
+        # 客户端用词条 ID 表示词库词，用字符串表示手动输入
+        items = []
+        for value in values:
+            if isinstance(value, int):
+                entry = self.vocab.by_id(value)
+                if entry is None:
+                    raise HTTPError(400, f"unknown item {value}")
+                items.append(entry)
+            elif isinstance(value, str) and value.strip():
+                items.append({'manual_text': value.strip(), 'category': 'manual'})
+            else:
+                raise HTTPError(400, "items must be ids or strings")
+        return items
+
+    def check_lang(self, lang):
+        if not isinstance(lang, str) or lang not in self.vocab.languages:
+            raise HTTPError(400, f"unknown language {lang}")
+        return lang
+
+    def audio_url(self, text, lang):
+        return "/api/audio?" + urllib.parse.urlencode({'text': text, 'lang': lang})
+
+    async def synthesize(self, text, lang, rate=None):
+        # 返回合成好的 wav 路径；缓存命中直接返回，同一段文字的并发请求共用一次合成
+        rate = rate or self.rate
+        voice_id = self.language_voices.get(lang)
+        path = self.audio_cache.get(text, voice_id, rate, 1.0)
+        if path:
+            self.metrics.count('server_cache_hits')
+            return path
+        key = self.audio_cache.make_key(text, voice_id, rate, 1.0)
+        future = self._renders.get(key)
+        if future is None:
+            if len(self._renders) >= SERVER_MAX_PENDING:
+                self.metrics.count('server_rejected')
+                raise HTTPError(503, "synthesis backlog full")
+            future = asyncio.ensure_future(self._render(key, text, voice_id, rate))
+            self._renders[key] = future
+            future.add_done_callback(lambda f: self._renders.pop(key, None))
+        self.metrics.gauge('server_pending_renders', len(self._renders))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), SERVER_RENDER_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPError(504, "synthesis timed out")
+
+    async def _render(self, key, text, voice_id, rate):
+        t0 = time.perf_counter()
+        target = self.audio_cache.path_for(key)
+        tmp = f"{target[:-4]}.{os.getpid()}.tmp.wav"
+        try:
+            ok = await asyncio.get_running_loop().run_in_executor(self.pool, _synthesize_clip, text, voice_id, rate, 1.0, tmp)
+        except Exception as e:
+            print(f"Synthesis error: {e}")
+            ok = False
+        if not ok:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise HTTPError(503, "synthesis failed")
+        os.replace(tmp, target)
+        self.audio_cache.add(key, text, voice_id, rate, 1.0)
+        self.metrics.observe('server_render', (time.perf_counter() - t0) * 1000)
+        return target
+
+    def warm(self, text, lang):
+        # 后台合成，客户端随后请求音频时直接命中缓存
+        task = asyncio.ensure_future(self.synthesize(text, lang))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    # --- HTTP ---
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    # 请求本身读不懂：回一个错误再关连接（后面的字节已经没法分帧了）
+                    self._write_response(writer, e.status, "application/json",
+                                         json.dumps({'error': str(e)}).encode('utf-8'), keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                if path == "/ws" and headers.get('upgrade', '').lower() == 'websocket':
+                    await self._websocket(reader, writer, headers)
+                    break
+                t0 = time.perf_counter()
+                try:
+                    status, content_type, payload = await self._route(method, path, query, body)
+                except HTTPError as e:
+                    status, content_type = e.status, "application/json"
+                    payload = json.dumps({'error': str(e)}).encode('utf-8')
+                except Exception as e:
+                    # 处理请求时的意外错误也要给客户端一个回应，不能让连接直接断掉
+                    print(f"Server error: {method} {path}: {e!r}")
+                    status, content_type = 500, "application/json"
+                    payload = json.dumps({'error': HTTP_REASONS[500]}).encode('utf-8')
+                self.metrics.observe(f"server_{path.strip('/').replace('/', '_') or 'index'}", (time.perf_counter() - t0) * 1000)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, content_type, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(" ", 2)
+        except ValueError:
+            raise HTTPError(400)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(400, "invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "invalid Content-Length")
+        if length > SERVER_MAX_BODY:
+            raise HTTPError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b""
+        url = urllib.parse.urlsplit(target)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        return method.upper(), url.path, query, headers, body
+
+    def _write_response(self, writer, status, content_type, payload, keep_alive=True):
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                f"Access-Control-Allow-Origin: *\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + payload)
+
+    async def _route(self, method, path, query, body):
+        lang = self.check_lang(query.get('lang', DEFAULT_LANGUAGE))
+        if method == "GET" and path == "/api/board":
+            return 200, "application/json; charset=utf-8", self.board_json(lang)
+        if method == "POST" and path == "/api/expand":
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "invalid JSON")
+            if not isinstance(request, dict):
+                raise HTTPError(400, "request must be a JSON object")
+            if not isinstance(request.get('items', []), list):
+                raise HTTPError(400, "items must be a list")
+            lang = self.check_lang(request.get('lang', lang))
+            items = self.resolve_items(request.get('items', []))
+            candidates = self.expander.expand(items, lang) if items else []
+            if candidates:
+                self.warm(candidates[0], lang)
+            return self._json(200, {'candidates': candidates, 'audio': self.audio_url(candidates[0], lang) if candidates else None})
+        if method == "GET" and path == "/api/audio":
+            text = query.get('text', '').strip()
+            if not text:
+                raise HTTPError(400, "missing text")
+            try:
+                rate = int(query['rate']) if 'rate' in query else None
+            except ValueError:
+                raise HTTPError(400, "invalid rate")
+            path = await self.synthesize(text, lang, rate)
+            with open(path, 'rb') as f:
+                return 200, "audio/wav", f.read()
+        if method == "GET" and path == "/api/stats":
+            stats = self.metrics.snapshot()
+            stats['sessions'] = len(self.sessions)
+            stats['pending_renders'] = len(self._renders)
+            return self._json(200, stats)
+        raise HTTPError(404)
+
+    @staticmethod
+    def _json(status, data):
+        return status, "application/json; charset=utf-8", json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+    # --- WebSocket ---
+    async def _websocket(self, reader, writer, headers):
+        # 每个连接一个会话：{"op": "tap", "id": 3} / "type" / "backspace" / "clear" / "play" / "expand" / "lang"，
+        # 每次操作回一条包含句子和音频地址的 JSON
+        accept = base64.b64encode(hashlib.sha1((headers.get('sec-websocket-key', '') + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode('latin-1'))
+        await writer.drain()
+        session = ServerSession(DEFAULT_LANGUAGE)
+        self.sessions.add(session)
+        try:
+            while True:
+                try:
+                    opcode, payload = await self._ws_read(reader)
+                except HTTPError:
+                    # 消息太大：按协议用 1009 关闭
+                    self._ws_write(writer, 0x8, (1009).to_bytes(2, 'big'))
+                    await writer.drain()
+                    break
+                if opcode == 0x8:
+                    self._ws_write(writer, 0x8, payload[:2])
+                    break
+                if opcode == 0x9:
+                    self._ws_write(writer, 0xA, payload)
+                elif opcode == 0x1:
+                    t0 = time.perf_counter()
+                    try:
+                        reply = self._session_op(session, json.loads(payload.decode('utf-8')))
+                    except (ValueError, KeyError, TypeError, HTTPError) as e:
+                        reply = {'type': 'error', 'error': str(e)}
+                    except Exception as e:
+                        print(f"Server error: websocket: {e!r}")
+                        reply = {'type': 'error', 'error': HTTP_REASONS[500]}
+                    self._ws_write(writer, 0x1, json.dumps(reply, ensure_ascii=False).encode('utf-8'))
+                    self.metrics.observe('server_ws_op', (time.perf_counter() - t0) * 1000)
+                await writer.drain()
+        finally:
+            self.sessions.discard(session)
+
+    def _session_op(self, session, message):
+        op = message['op']
+        audio = None
+        if op in ('tap', 'type'):
+            session.sentence.extend(self.resolve_items([message['id'] if op == 'tap' else message['text']]))
+            audio = self._text(session.sentence[-1], session.lang)
+        elif op == 'backspace':
+            del session.sentence[-1:]
+        elif op == 'clear':
+            session.sentence = []
+        elif op == 'lang':
+            session.lang = self.check_lang(message['lang'])
+            session.sentence = []
+        elif op == 'play':
+            audio = " ".join(self._text(item, session.lang) for item in session.sentence)
+        elif op == 'expand':
+            if session.sentence:
+                candidates = self.expander.expand(session.sentence, session.lang)
+                self.warm(candidates[0], session.lang)
+                return {'type': 'expansion', 'candidates': candidates, 'audio': self.audio_url(candidates[0], session.lang)}
+            return {'type': 'expansion', 'candidates': [], 'audio': None}
+        else:
+            raise ValueError(f"unknown op {op}")
+        if audio:
+            self.warm(audio, session.lang)
+        return {
+            'type': 'sentence',
+            'lang': session.lang,
+            'items': [item['manual_text'] if 'manual_text' in item else item.id for item in session.sentence],
+            'text': " ".join(self._text(item, session.lang) for item in session.sentence),
+            'audio': self.audio_url(audio, session.lang) if audio else None,
+        }
+
+    @staticmethod
+    def _text(item, lang):
+        return item['manual_text'] if 'manual_text' in item else item[lang]
+
+    @staticmethod
+    async def _ws_read(reader):
+        # 读一个完整消息（客户端发来的帧都带掩码），分片的消息拼接起来
+        chunks = []
+        first = 0x1
+        while True:
+            head = await reader.readexactly(2)
+            fin, opcode = head[0] & 0x80, head[0] & 0x0F
+            length = head[1] & 0x7F
+            if length == 126:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await reader.readexactly(8), 'big')
+            if length > SERVER_MAX_BODY:
+                raise HTTPError(413)
+            mask = await reader.readexactly(4) if head[1] & 0x80 else None
+            data = await reader.readexactly(length)
+            if mask:
+                data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+            if opcode >= 0x8:
+                return opcode, data
+            chunks.append(data)
+            if opcode:
+                first = opcode
+            if fin:
+                return first, b"".join(chunks)
+
+    @staticmethod
+    def _ws_write(writer, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = bytes([0x80 | opcode, length])
+        elif length < 65536:
+            head = bytes([0x80 | opcode, 126]) + length.to_bytes(2, 'big')
+        else:
+            head = bytes([0x80 | opcode, 127]) + length.to_bytes(8, 'big')
+        writer.write(head + payload)
+
+
+def run_server(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS, engine_factory=None, data_dir=APP_DATA_DIR):
+    server = AACServer(engine_factory=engine_factory, data_dir=data_dir, host=host, port=port, workers=workers)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+# --- 批量预合成 ---
+# 新词库、换语音或语速后一次性把所有词汇和常用句合成好：进程池并行（每个工作进程一个引擎），
+# 每段音频 gzip 压缩存成 <缓存键>.wav.gz，清单记录键和元数据。中断后重新运行会跳过已完成的部分
+PRERENDER_DIR_NAME = "prerendered"
+PRERENDER_MANIFEST = "manifest.json"
+PRERENDER_SAVE_EVERY = 50  # 每完成这么多段就把清单写一次盘
+
+
+def load_prerender_manifest(directory):
+    try:
+        with open(os.path.join(directory, PRERENDER_MANIFEST), encoding='utf-8') as f:
+            return json.load(f)['clips']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_prerender_manifest(directory, clips):
+    path = os.path.join(directory, PRERENDER_MANIFEST)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'clips': clips}, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _prerender_clip(text, voice_id, rate, volume, target):
+    # 在工作进程里合成并压缩，写完后才改名，中断不会留下半个文件；返回压缩后的大小（失败为 0）
+    tmp = f"{target}.{os.getpid()}.tmp"
+    try:
+        if not _synthesize_clip(text, voice_id, rate, volume, tmp + ".wav"):
+            return 0
+        with open(tmp + ".wav", 'rb') as src, gzip.open(tmp, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, target)
+        return os.path.getsize(target)
+    finally:
+        for path in (tmp, tmp + ".wav"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def prerender_clips(directory, jobs, workers=SERVER_WORKERS, engine_factory=None, out=sys.stderr):
+    # jobs: (文本, 语音ID, 语速, 音量)；返回失败的数量
+    os.makedirs(directory, exist_ok=True)
+    clips = load_prerender_manifest(directory)
+    todo = {}
+    for text, voice_id, rate, volume in jobs:
+        key = AudioCache.make_key(text, voice_id, rate, volume)
+        if key in todo or key in clips and os.path.exists(os.path.join(directory, key + ".wav.gz")):
+            continue
+        meta = {'text': text, 'voice_id': voice_id, 'rate': rate, 'volume': volume}
+        target = os.path.join(directory, key + ".wav.gz")
+        if os.path.exists(target):
+            # 上次中断时已经写完、但还没记进清单
+            clips[key] = dict(meta, size=os.path.getsize(target))
+            continue
+        todo[key] = meta
+    print(f"{len(clips) + len(todo)} clips: {len(clips)} up to date, {len(todo)} to render with {workers} workers", file=out)
+    if not todo:
+        save_prerender_manifest(directory, clips)
+        return 0
+
+    done = failed = 0
+    t0 = time.perf_counter()
+    pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_synthesis_worker, initargs=(engine_factory,))
+    try:
+        futures = {pool.submit(_prerender_clip, meta['text'], meta['voice_id'], meta['rate'], meta['volume'],
+                               os.path.join(directory, key + ".wav.gz")): key for key, meta in todo.items()}
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                print(f"\nPrerender error ({todo[key]['text']!r}): {e}", file=out)
+                size = 0
+            if size:
+                clips[key] = dict(todo[key], size=size)
+                done += 1
+            else:
+                failed += 1
+            finished = done + failed
+            if finished % PRERENDER_SAVE_EVERY == 0:
+                save_prerender_manifest(directory, clips)
+            elapsed = time.perf_counter() - t0
+            eta = elapsed / finished * (len(todo) - finished)
+            print(f"\r[{finished}/{len(todo)}] {finished * 100 // len(todo)}%  {finished / elapsed:.1f} clips/s  ETA {eta:.0f}s ",
+                  end="", file=out, flush=True)
+    except KeyboardInterrupt:
+        print("\nInterrupted; progress saved, run again to resume", file=out)
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        save_prerender_manifest(directory, clips)
+    pool.shutdown()
+    print(f"\nRendered {done} clips in {time.perf_counter() - t0:.1f}s, {failed} failed", file=out)
+    return failed
+
+
+def run_prerender(data_dir=APP_DATA_DIR, vocab_path=VOCABULARY_FILE, phrase_files=(), voices=(), rate=150,
+                  workers=SERVER_WORKERS, engine_factory=None, out_dir=None):
+    # 合成的内容与应用后台预合成的一致（所有语言的词汇、扩展句、紧急呼叫），另外可以加 lang=path 形式的短语文件（每行一句）。
+    # 默认写到数据目录下应用启动时会读取的位置
+    core = AACCore(engine_factory=engine_factory, data_dir=data_dir, vocab_path=vocab_path)
+    core.rate = rate
+    for spec in voices:
+        lang, _, voice_id = spec.partition('=')
+        core.language_voices[lang] = voice_id
+    missing = [lang for lang in core.locales.languages if lang not in core.language_voices]
+    if missing:
+        # 没有缓存的语音列表时先在一个工作进程里枚举语音
+        with concurrent.futures.ProcessPoolExecutor(1, initializer=_init_synthesis_worker, initargs=(engine_factory,)) as pool:
+            found = pool.submit(_list_worker_voices).result()
+        for lang, voice_id in pick_language_voices(found, core.locales.languages).items():
+            core.language_voices.setdefault(lang, voice_id)
+        save_voice_cache(core.tts_driver, found, core.language_voices, core.voice_cache_file)
+    core.current_voice_id = core.language_voices.get(core.current_language, core.current_voice_id)
+
+    def jobs():
+        for text, voice_id, job_rate in core.audio_jobs(core.locales.languages):
+            yield text, voice_id, job_rate, 1.0
+        for spec in phrase_files:
+            lang, _, path = spec.partition('=')
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield line.strip(), core.voice_for_language(lang), rate, 1.0
+
+    directory = out_dir or os.path.join(data_dir, PRERENDER_DIR_NAME)
+    return 1 if prerender_clips(directory, jobs(), workers, engine_factory) else 0
+
+
+# --- 基准测试 ---
+BENCH_TOLERANCE = 1.5  # 比基线慢 50% 以上视为性能回退
+
+
+def _percentiles(samples):
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+
+def write_synthetic_vocabulary(path, sizes):
+    # 生成每个分类分别有 sizes 个词的词库文件，用于测量不同面板规模的渲染开销
+    data = {'languages': ['zh', 'en'], 'categories': [], 'entries': {}}
+    next_id = 1
+    for size in sizes:
+        cat_id = f"size{size}"
+        data['categories'].append({'id': cat_id, 'labels': {'zh': str(size), 'en': str(size)}, 'icon': '🔢', 'color': '#64748b'})
+        data['entries'][cat_id] = [[next_id + i, '🙂', f"词{next_id + i}", f"word{next_id + i}"] for i in range(size)]
+        next_id += size
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def bench_tap_to_enqueue(data_dir, taps=2000):
+    # 点击词卡（核心 add）到语音任务入队的耗时
+    core = AACCore(engine_factory=FakeTTSEngine, data_dir=data_dir)
+    core.start()
+    items = list(core.vocab)
+    samples = []
+    for i in range(taps):
+        t0 = time.perf_counter()
+        core.add(items[i % len(items)])
+        samples.append((time.perf_counter() - t0) * 1000)
+        if len(core.sentence) >= 8:
+            core.clear()
+    core.close()
+    return {'tap_to_enqueue_ms': _percentiles(samples)}
+
+
+def bench_expansion(data_dir, sentences=5000):
+    # 扩展吞吐量：冷（清空记忆化缓存）和热两种情况下每次扩展的平均微秒数
+    core = AACCore(engine_factory=FakeTTSEngine, data_dir=data_dir)
+    items = list(core.vocab)
+    rng = random.Random(1)
+    batch = [[rng.choice(items) for _ in range(rng.randint(1, 5))] for _ in range(sentences)]
+    results = {}
+    for lang in core.expander.languages():
+        core.expander._memo.clear()
+        t0 = time.perf_counter()
+        for sentence in batch:
+            core.expander.expand(sentence, lang)
+        cold = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for sentence in batch:
+            core.expander.expand(sentence, lang)
+        warm = time.perf_counter() - t0
+        results[f'expansion_{lang}_us'] = {'cold': round(cold / sentences * 1e6, 3), 'warm': round(warm / sentences * 1e6, 3)}
+    return results
+
+
+def bench_emergency(data_dir, trials=30, cold_trials=10, start_delay=0.005, cache_hold=0.15, rounds=3):
+    # 紧急呼叫：从触发到播放器开始放警报音的耗时（播放器按 start_delay 模拟启动进程）。
+    # warm：呼救语音已经合成好，语音线程正忙着说话、队列里堆满点击和预合成；
+    # cold：刚启动、呼救语音还没合成好，触发时另一个线程正占着音频缓存的锁；
+    # no_player：播放器不可用时呼救语音已经合成好，也要每一轮都用 TTS 说出来
+    def trigger(core, player):
+        started = threading.Event()
+        alarm_dir = core.alarm.directory
+        tone = []
+
+        def on_start(path, at):
+            if os.path.dirname(path) == alarm_dir and not tone:
+                tone.append(at)
+                started.set()
+
+        player.on_start = on_start
+        t0 = time.perf_counter()
+        core.emergency()
+        started.wait(5)
+        core.acknowledge_emergency()
+        player.on_start = None
+        return ((tone[0] if tone else time.perf_counter()) - t0) * 1000
+
+    def wait_ready(core):
+        deadline = time.monotonic() + 10
+        while not core.alarm.ready(core.current_language) and time.monotonic() < deadline:
+            core.alarm._load_clips()
+            time.sleep(0.05)
+
+    player = FakePlayer(start_delay)
+    core = AACCore(engine_factory=lambda: FakeTTSEngine(word_time=0.02), player=player, data_dir=os.path.join(data_dir, "warm"))
+    core.start()
+    wait_ready(core)
+    items = list(core.vocab)
+    warm = []
+    for i in range(trials):
+        for item in items[i:i + 20]:
+            core.add(item)
+        core.play()
+        time.sleep(0.05)
+        warm.append(trigger(core, player))
+        core.clear()
+    core.close()
+
+    cold = []
+    for i in range(cold_trials):
+        player = FakePlayer(start_delay)
+        core = AACCore(engine_factory=lambda: FakeTTSEngine(word_time=0.02), player=player, data_dir=os.path.join(data_dir, f"cold{i}"))
+        core.start()
+        held = threading.Event()
+
+        def hold(cache=core.audio_cache):
+            with cache._lock:
+                held.set()
+                time.sleep(cache_hold)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        held.wait()
+        cold.append(trigger(core, player))
+        holder.join()
+        core.close()
+
+    utterances = []
+
+    def engine_factory():
+        engine = FakeTTSEngine(word_time=0.02)
+        engine.connect('started-utterance', lambda name: utterances.append(time.perf_counter()))
+        return engine
+
+    player = FakePlayer(start_delay)
+    player.available = False
+    core = AACCore(engine_factory=engine_factory, player=player, data_dir=os.path.join(data_dir, "no_player"))
+    core.start()
+    wait_ready(core)
+    chunks = len(split_phrases(core.t('emergency_msg')))
+    del utterances[:]
+    t0 = time.perf_counter()
+    core.emergency()
+    deadline = time.monotonic() + rounds * (EMERGENCY_REPEAT_GAP_S + 2)
+    while len(utterances) < rounds * chunks and time.monotonic() < deadline:
+        time.sleep(0.01)
+    core.acknowledge_emergency()
+    spoken = len(utterances) // chunks
+    first = round((utterances[0] - t0) * 1000, 4) if utterances else None
+    core.close()
+    return {'emergency_start_ms': dict(_percentiles(warm), max=round(max(warm), 4)),
+            'emergency_start_cold_ms': dict(_percentiles(cold), max=round(max(cold), 4)),
+            'emergency_no_player': {'rounds_spoken': min(spoken, rounds), 'rounds': rounds, 'first_speech_ms': first}}
+
+
+def bench_usage_log(data_dir, events=20000):
+    # 使用记录：点击路径上 record() 的开销，以及后台线程编码写盘时每条的开销
+    log = UsageLog(os.path.join(data_dir, USAGE_LOG_FILE))
+    t0 = time.perf_counter()
+    for i in range(events):
+        log.record('tap', 101 + i % 50, 'people')
+    record = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    written = log.flush()
+    flush = time.perf_counter() - t0
+    log.close()
+    read = sum(1 for _ in read_usage_log(log.path))
+    return {'usage_log_us': {'record': round(record / events * 1e6, 3), 'flush': round(flush / max(1, written) * 1e6, 3)},
+            'usage_log_lost': events - read}
+
+
+def bench_phrase_search(data_dir, phrases=30000, queries=300):
+    # 常用句搜索：在几万条句子里模拟逐字输入，每次按键一次搜索的耗时
+    core = AACCore(engine_factory=FakeTTSEngine, data_dir=data_dir)
+    rng = random.Random(2)
+    words = {lang: [entry[lang] for entry in core.vocab] for lang in ('en', 'zh')}
+    for i in range(phrases):
+        lang = 'en' if i % 3 else 'zh'
+        core.phrases.add(" ".join(rng.choice(words[lang]) for _ in range(rng.randint(3, 9))), lang, rng.randint(1, 20))
+    # 打开常用句窗口时先显示最常用的（建好排名），第一次输入时建索引
+    core.phrases.search("")
+    core.phrases.search("warm up the index")
+    samples = []
+    for _ in range(queries):
+        lang = 'en' if rng.random() < 0.7 else 'zh'
+        target = " ".join(rng.choice(words[lang]) for _ in range(3))
+        for end in range(1, len(target) + 1):
+            t0 = time.perf_counter()
+            core.search_phrases(target[:end])
+            samples.append((time.perf_counter() - t0) * 1000)
+    return {'phrase_search_ms': _percentiles(samples)}
+
+
+def bench_render(data_dir, sizes=(25, 100, 500, 2000)):
+    # 不同规模面板第一次切换（建面板）和再次切换（已缓存）的耗时；需要显示器
+    path = os.path.join(data_dir, "vocabulary.json")
+    write_synthetic_vocabulary(path, sizes)
+    core = AACCore(engine_factory=FakeTTSEngine, data_dir=data_dir, vocab_path=path)
+    try:
+        app = AACApp(core)
+    except tk.TclError as e:
+        return {'render_ms': f"skipped ({e})"}
+    app.update()
+    results = {}
+    for size in sizes:
+        timings = []
+        for _ in range(2):
+            app.change_category(f"size{sizes[0] if size != sizes[0] else sizes[-1]}")
+            app.update()
+            t0 = time.perf_counter()
+            app.change_category(f"size{size}")
+            app.update_idletasks()
+            timings.append(round((time.perf_counter() - t0) * 1000, 3))
+        results[str(size)] = {'first': timings[0], 'cached': timings[1]}
+    app.on_close()
+    return {'render_ms': results}
+
+
+def bench_server(data_dir, requests=200):
+    # 服务器模式：本机客户端发正常请求测耗时，再发各种不合法的请求，每一个都必须收到预期的状态码而不是断开连接
+    bad = [
+        ("POST", "/api/expand", b"[1,2]", 400),
+        ("POST", "/api/expand", b'{"items": 5}', 400),
+        ("POST", "/api/expand", b'{"lang": [1], "items": []}', 400),
+        ("POST", "/api/expand", b'{"items": [999999]}', 400),
+        ("POST", "/api/expand", b"{not json", 400),
+        ("GET", "/api/audio", b"", 400),
+        ("GET", "/missing", b"", 404),
+    ]
+
+    async def send(port, method, path, body=b"", head=None):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            writer.write((head or f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode('latin-1') + body)
+            await writer.drain()
+            line = await reader.readline()
+            await reader.read()
+            return int(line.split()[1]) if line else None
+        finally:
+            writer.close()
+
+    async def run():
+        server = AACServer(engine_factory=FakeTTSEngine, data_dir=data_dir, host="127.0.0.1", port=0, workers=1)
+        await server.start()
+        try:
+            samples = {'board': [], 'expand': []}
+            for i in range(requests):
+                t0 = time.perf_counter()
+                await send(server.port, "GET", "/api/board")
+                samples['board'].append((time.perf_counter() - t0) * 1000)
+                t0 = time.perf_counter()
+                await send(server.port, "POST", "/api/expand", json.dumps({'items': [101, 201 + i % 5]}).encode())
+                samples['expand'].append((time.perf_counter() - t0) * 1000)
+            failed = []
+            for method, path, body, expected in bad:
+                status = await send(server.port, method, path, body)
+                if status != expected:
+                    failed.append(f"{method} {path} {body[:20]!r}: {status}")
+            for head, expected in (("POST /api/expand HTTP/1.1\r\nContent-Length: x\r\n\r\n", 400),
+                                   (f"POST /api/expand HTTP/1.1\r\nContent-Length: {SERVER_MAX_BODY + 1}\r\n\r\n", 413)):
+                status = await send(server.port, None, None, head=head)
+                if status != expected:
+                    failed.append(f"{head.splitlines()[1]}: {status}")
+            return {'server_ms': {name: _percentiles(values) for name, values in samples.items()}, 'server_failed': failed}
+        finally:
+            server.close()
+
+    return asyncio.run(run())
+
+
+def bench_startup(data_dir, runs=3):
+    # 在子进程里冷启动，取首次绘制和首次发声的中位数
+    samples = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--bench-startup", "--fake-tts", "--data-dir", data_dir],
+                              capture_output=True, text=True, timeout=120)
+        try:
+            samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        except (ValueError, IndexError):
+            return {'startup_ms': f"skipped ({proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'no output'})"}
+    results = {}
+    for key in ('first_paint_ms', 'first_speech_ms'):
+        values = sorted(s[key] for s in samples if s.get(key) is not None)
+        if values:
+            results[key] = values[len(values) // 2]
+    return {'startup_ms': results}
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def run_benchmarks(out=None, baseline=None):
+    # 使用假 TTS 后端的基准测试集；紧急呼叫启动超过 EMERGENCY_MAX_START_MS，
+    # 或给出 baseline 时数值超过基线 BENCH_TOLERANCE 倍即返回 1
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for name, bench in (('tap', bench_tap_to_enqueue), ('emergency', bench_emergency), ('expansion', bench_expansion),
+                            ('usage', bench_usage_log), ('phrases', bench_phrase_search),
+                            ('server', bench_server), ('render', bench_render), ('startup', bench_startup)):
+            bench_dir = os.path.join(data_dir, name)
+            os.makedirs(bench_dir)
+            results.update(bench(bench_dir))
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    # 紧急呼叫的启动耗时是绝对上限，不管有没有基线都检查
+    regressions = []
+    for key in ('emergency_start_ms', 'emergency_start_cold_ms'):
+        if results[key]['max'] > EMERGENCY_MAX_START_MS:
+            regressions.append(f"{key}.max: {results[key]['max']} (limit {EMERGENCY_MAX_START_MS})")
+    for failure in results['server_failed']:
+        regressions.append(f"server: {failure}")
+    silent = results['emergency_no_player']
+    if silent['rounds_spoken'] < silent['rounds']:
+        regressions.append(f"emergency_no_player.rounds_spoken: {silent['rounds_spoken']} (expected {silent['rounds']})")
+    reference = {}
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            reference = _flatten(json.load(f))
+    for key, value in _flatten(results).items():
+        if key in reference and reference[key] > 0 and value > reference[key] * BENCH_TOLERANCE:
+            regressions.append(f"{key}: {value} (baseline {reference[key]})")
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+def run_startup_benchmark(timeout=30.0, engine_factory=None, data_dir=APP_DATA_DIR):
+    # 测量从进程启动到首次绘制、首次发声的时间（毫秒）
+    spoke = []
+    app = AACApp(engine_factory=engine_factory, data_dir=data_dir)
+    app.update()
+    first_paint = time.perf_counter()
+    app.core.speech.on_start = lambda: spoke.append(time.perf_counter())
+    app.add_to_sentence(app.core.vocab.by_category(app.core.current_category)[0])
+    deadline = time.perf_counter() + timeout
+    while not spoke and time.perf_counter() < deadline:
+        app.update()
+        time.sleep(0.005)
+    results = {
+        'first_paint_ms': round((first_paint - _PROCESS_START) * 1000, 1),
+        'first_speech_ms': round((spoke[0] - _PROCESS_START) * 1000, 1) if spoke else None,
+    }
+    app.on_close()
+    print(json.dumps(results))
+    return results
+
+
+# --- 回放压力测试 ---
+# 按设定速率把点击序列（随机生成，或取自 usage.jsonl）送进界面，用不发声但按词耗时的假 TTS，
+# 测量主循环延迟、重绘耗时、语音排队、线程数和内存随时间的变化，超过阈值时返回 1，可以当作响应速度的回归门槛。
+# 没有显示器时只驱动 AACCore，后台结果仍像界面那样经队列交回驱动循环执行
+REPLAY_RATE = 10.0          # 每秒操作数
+REPLAY_DURATION = 30.0      # 随机生成时的时长（秒）
+REPLAY_TICK_MS = 10         # 驱动循环的间隔，实际间隔超出的部分记为主循环延迟
+REPLAY_SAMPLE_S = 0.25      # 排队、线程、内存的采样间隔
+REPLAY_SETTLE_S = 2.0       # 操作送完后继续观察的时间
+REPLAY_WORD_TIME = 0.05     # 假 TTS 每个词“说”多久
+REPLAY_MIX = (('tap', 70), ('category', 8), ('backspace', 7), ('play', 6), ('expand', 5), ('clear', 3), ('emergency', 1))
+REPLAY_MAX_SENTENCE = 12
+REPLAY_ACK_S = 1.5          # 紧急警报响多久后模拟有人确认
+REPLAY_THRESHOLDS = {
+    'emergency_start_ms.max': EMERGENCY_MAX_START_MS,
+    'loop_lag_ms.p99': 100.0,
+    'action_ms.p99': 50.0,
+    'redraw_ms.p99': 50.0,
+    'speech_backlog.max': 20,
+    'threads.max': 24,
+    'memory_mb.growth': 64.0,
+}
+
+
+def _rss_mb():
+    # 当前常驻内存；没有 /proc 时退回进程峰值，都拿不到返回 None
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+    return None
+
+
+def generate_replay(core, duration=REPLAY_DURATION, rate=REPLAY_RATE, seed=0):
+    # 按 REPLAY_MIX 的比例随机生成操作，点击只点当前分类里的词卡，句子太长时先清空
+    rng = random.Random(seed)
+    kinds = [kind for kind, _ in REPLAY_MIX]
+    weights = [weight for _, weight in REPLAY_MIX]
+    categories = [cat['id'] for cat in core.categories_data]
+    category, length, actions = core.current_category, 0, []
+    for _ in range(int(duration * rate)):
+        kind = 'clear' if length >= REPLAY_MAX_SENTENCE else rng.choices(kinds, weights)[0]
+        if kind == 'tap':
+            entries = core.vocab.by_category(category)
+            if not entries:
+                continue
+            actions.append(('tap', rng.choice(entries).id))
+            length += 1
+        elif kind == 'category':
+            category = rng.choice(categories)
+            actions.append(('category', category))
+        else:
+            actions.append((kind,))
+            if kind == 'backspace':
+                length = max(0, length - 1)
+            elif kind == 'clear':
+                length = 0
+    return actions
+
+
+def load_replay(path):
+    # 从使用记录里取出能重放的操作（词卡点击、手动输入、分类切换、删除、清空、播放、扩展、紧急呼叫、常用句）
+    actions = []
+    for _, kind, fields in read_usage_log(path):
+        if kind == 'tap' and fields:
+            actions.append(('tap', fields[0]) if fields[0] is not None else ('type', fields[-1]))
+        elif kind == 'category' and fields:
+            actions.append(('category', fields[0]))
+        elif kind == 'phrase' and len(fields) >= 2:
+            actions.append(('phrase', fields[0], fields[1]))
+        elif kind in ('backspace', 'clear', 'play', 'expand', 'emergency'):
+            actions.append((kind,))
+    return actions
+
+
+class ReplayHarness:
+    # 有 app 时通过界面的处理函数操作，在 Tk 主循环的 after 定时器里驱动；否则直接调用核心
+    def __init__(self, core, app=None):
+        self.core = core
+        self.app = app
+        self.samples = {'loop_lag_ms': [], 'action_ms': []}
+        self.timeline = []  # [秒, 语音排队, 线程数, 内存MB]
+        self._dispatch = None
+        if app is not None:
+            self.handlers = {
+                'tap': lambda item_id: self._tap(app.add_to_sentence, item_id),
+                'type': lambda text: app.add_to_sentence({'manual_text': text, 'category': 'manual'}),
+                'category': app.change_category,
+                'backspace': app.backspace,
+                'clear': app.clear_sentence,
+                'play': app.play_sentence,
+                'expand': app.ai_expand,
+                'emergency': app.trigger_emergency,
+                'phrase': lambda lang, text: core.recall_phrase(text, lang),
+            }
+        else:
+            self._dispatch = queue.SimpleQueue()
+            core.post = self._dispatch.put
+            self.handlers = {
+                'tap': lambda item_id: self._tap(core.add, item_id),
+                'type': lambda text: core.add({'manual_text': text, 'category': 'manual'}),
+                'category': core.set_category,
+                'backspace': core.backspace,
+                'clear': core.clear,
+                'play': core.play,
+                'expand': core.expand,
+                'emergency': core.emergency,
+                'phrase': lambda lang, text: core.recall_phrase(text, lang),
+            }
+
+    def _tap(self, add, item_id):
+        entry = self.core.vocab.by_id(item_id)
+        if entry is not None:
+            add(entry)
+
+    def run(self, actions, rate=REPLAY_RATE):
+        self.actions = actions
+        self.interval = 1.0 / rate
+        self.next_action = 0
+        self.start = self.last_tick = time.perf_counter()
+        self.next_sample = self.start
+        self.end = self.start + len(actions) * self.interval + REPLAY_SETTLE_S
+        self.threads_start = threading.active_count()
+        self.memory_start = _rss_mb()
+        if self.app is not None:
+            self.app.after(REPLAY_TICK_MS, self._app_tick)
+            self.app.mainloop()
+        else:
+            while self._tick():
+                time.sleep(REPLAY_TICK_MS / 1000)
+        return self.report(rate)
+
+    def _app_tick(self):
+        if self._tick():
+            self.app.after(REPLAY_TICK_MS, self._app_tick)
+        else:
+            self.app.quit()
+
+    def _tick(self):
+        now = time.perf_counter()
+        self.samples['loop_lag_ms'].append(max(0.0, (now - self.last_tick) * 1000 - REPLAY_TICK_MS))
+        self.last_tick = now
+        while self.next_action < len(self.actions) and self.start + self.next_action * self.interval <= now:
+            kind, *params = self.actions[self.next_action]
+            self.next_action += 1
+            t0 = time.perf_counter()
+            try:
+                self.handlers[kind](*params)
+            except Exception as e:
+                print(f"Replay {kind} error: {e}")
+            self.samples['action_ms'].append((time.perf_counter() - t0) * 1000)
+        alarm = self.core.alarm
+        if alarm.active and now - alarm.triggered_at >= REPLAY_ACK_S:
+            (self.app.acknowledge_emergency if self.app is not None else self.core.acknowledge_emergency)()
+        if self._dispatch is not None:
+            for _ in range(DISPATCH_BATCH):
+                try:
+                    fn = self._dispatch.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"Replay dispatch error: {e}")
+        if now >= self.next_sample:
+            self.next_sample += REPLAY_SAMPLE_S
+            self.timeline.append([round(now - self.start, 2), self.core.speech.backlog(), threading.active_count(), _rss_mb()])
+        return now < self.end
+
+    def report(self, rate):
+        metrics = self.core.metrics
+        with metrics._lock:
+            redraws = [ms for name, values in metrics.samples.items() if name.startswith('redraw_') for ms in values]
+            alarms = list(metrics.samples.get('emergency_start', ()))
+        summary = lambda values: dict(_percentiles(values), max=round(max(values), 4)) if values else None
+        memory = [sample[3] for sample in self.timeline if sample[3] is not None]
+        return {
+            'mode': 'app' if self.app is not None else 'core',
+            'actions': len(self.actions),
+            'rate': rate,
+            'duration_s': round(self.last_tick - self.start, 2),
+            'loop_lag_ms': summary(self.samples['loop_lag_ms']),
+            'action_ms': summary(self.samples['action_ms']),
+            'redraw_ms': summary(redraws),
+            'tap_to_audio_ms': metrics.percentiles('tap->audio_start'),
+            'emergency_start_ms': summary(alarms),
+            'speech_backlog': {'max': max(s[1] for s in self.timeline), 'final': self.timeline[-1][1]},
+            'threads': {'start': self.threads_start, 'max': max(s[2] for s in self.timeline)},
+            'memory_mb': {'start': self.memory_start, 'max': max(memory),
+                          'growth': round(memory[-1] - memory[0], 1)} if memory else None,
+            'counters': dict(metrics.counters),
+            'timeline': self.timeline,
+        }
+
+
+def run_replay(source=None, rate=REPLAY_RATE, duration=REPLAY_DURATION, seed=0, thresholds=(), out=None, headless=False):
+    # source 为 usage.jsonl 路径时重放记录，否则随机生成；结果打印为 JSON，超过阈值返回 1。
+    # 在临时数据目录里运行，不会写进真实的使用记录和学习数据
+    limits = dict(REPLAY_THRESHOLDS)
+    for spec in thresholds:
+        name, _, value = spec.partition('=')
+        limits[name] = float(value)
+    engine_factory = lambda: FakeTTSEngine(word_time=REPLAY_WORD_TIME)
+    with tempfile.TemporaryDirectory() as data_dir:
+        core = AACCore(engine_factory=engine_factory, data_dir=data_dir)
+        actions = load_replay(source) if source else generate_replay(core, duration, rate, seed)
+        if not actions:
+            print(f"Nothing to replay in {source}")
+            return 1
+        app = None
+        if not headless:
+            try:
+                app = AACApp(core)
+                app.show_dialogs = False
+                app.update()
+            except tk.TclError as e:
+                print(f"No display ({e}); replaying against the core only", file=sys.stderr)
+        if app is None:
+            core.start()
+        report = ReplayHarness(core, app).run(actions, rate)
+        if app is not None:
+            app.on_close()
+        else:
+            core.close()
+    flat = _flatten(report)
+    report['violations'] = [f"{name}: {flat[name]} > {limit}" for name, limit in limits.items()
+                            if flat.get(name) is not None and flat[name] > limit]
+    summary = {key: value for key, value in report.items() if key != 'timeline'}
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    for line in report['violations']:
+        print(f"THRESHOLD {line}")
+    return 1 if report['violations'] else 0
+
+
 if __name__ == "__main__":
-    app = AACApp()
-    app.mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Selftronic AAC V1R3")
+    parser.add_argument("--fake-tts", action="store_true", help="use a silent fake TTS engine")
+    parser.add_argument("--data-dir", default=APP_DATA_DIR, help="directory for caches and learned data")
+    parser.add_argument("--bench", action="store_true", help="run the benchmark suite with a fake TTS backend")
+    parser.add_argument("--bench-out", help="write benchmark results to this JSON file")
+    parser.add_argument("--baseline", help="fail if results regress against this benchmark JSON file")
+    parser.add_argument("--bench-startup", action="store_true", help="measure time to first paint and first speech, then exit")
+    parser.add_argument("--server", action="store_true", help="run the headless multi-client HTTP/WebSocket server")
+    parser.add_argument("--host", default=SERVER_HOST, help="server bind address (default: localhost only)")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="server port")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="number of TTS worker processes for --server and --prerender")
+    parser.add_argument("--prerender", action="store_true", help="batch-synthesize the board into compressed clips the app loads at startup")
+    parser.add_argument("--vocab", default=VOCABULARY_FILE, help="vocabulary file to pre-render or label --stats with")
+    parser.add_argument("--phrases", action="append", default=[], metavar="LANG=FILE", help="extra phrase list to pre-render (one phrase per line)")
+    parser.add_argument("--voice", action="append", default=[], metavar="LANG=VOICE_ID", help="voice to pre-render a language with")
+    parser.add_argument("--rate", type=int, default=150, help="speech rate to pre-render at")
+    parser.add_argument("--prerender-out", help="output directory (default: prerendered/ in the data directory)")
+    parser.add_argument("--perf-overlay", action="store_true", help="show the latency overlay on start (toggle with F12)")
+    parser.add_argument("--perf-export", help="write tap-to-speech latency metrics to this JSON file on exit")
+    parser.add_argument("--stats", action="store_true", help="print usage statistics from the usage log in the data directory")
+    parser.add_argument("--replay", nargs="?", const="", metavar="USAGE_LOG",
+                        help="load-test the UI with a fake TTS: replay taps from a usage log, or generated taps if no file is given")
+    parser.add_argument("--replay-rate", type=float, default=REPLAY_RATE, help="actions per second for --replay")
+    parser.add_argument("--replay-duration", type=float, default=REPLAY_DURATION, help="seconds of generated input for --replay")
+    parser.add_argument("--replay-seed", type=int, default=0, help="random seed for generated --replay input")
+    parser.add_argument("--replay-out", help="write the full --replay report (with timeline) to this JSON file")
+    parser.add_argument("--replay-headless", action="store_true", help="drive the core only, even when a display is available")
+    parser.add_argument("--threshold", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a --replay threshold, e.g. loop_lag_ms.p99=50")
+    args = parser.parse_args()
+    engine_factory = FakeTTSEngine if args.fake_tts else None
+    if args.bench:
+        sys.exit(run_benchmarks(args.bench_out, args.baseline))
+    elif args.prerender:
+        sys.exit(run_prerender(args.data_dir, args.vocab, args.phrases, args.voice, args.rate, args.workers,
+                               engine_factory=engine_factory, out_dir=args.prerender_out))
+    elif args.server:
+        run_server(args.host, args.port, args.workers, engine_factory=engine_factory, data_dir=args.data_dir)
+    elif args.replay is not None:
+        sys.exit(run_replay(args.replay, args.replay_rate, args.replay_duration, args.replay_seed, args.threshold,
+                            args.replay_out, args.replay_headless))
+    elif args.stats:
+        sys.exit(run_usage_stats(args.data_dir, args.vocab))
+    elif args.bench_startup:
+        run_startup_benchmark(engine_factory=engine_factory, data_dir=args.data_dir)
+    else:
+        app = AACApp(engine_factory=engine_factory, data_dir=args.data_dir)
+        app.core.metrics_export = args.perf_export
+        if args.perf_overlay:
+            app.toggle_perf_overlay()
+        app.mainloop()